@@ -1,14 +1,16 @@
 from abc import ABCMeta, abstractmethod
-from .exceptions import PageNotFound, ServerError
+from .exceptions import PageNotFound, RecordDoesNotExist, ServerError
+from .ratelimit import get_governor
 import datetime
-import http.client
+import gzip
 import json
 import random
 import string
 import logging
 import re
-import urllib.request, urllib.parse, urllib.error
-import xml.dom.minidom as xml
+import threading
+import zlib
+from collections import OrderedDict
 
 log = logging.getLogger('ehb_datasources')
 
@@ -132,6 +134,73 @@ class Driver(object, metaclass=ABCMeta):
         '''
         pass
 
+    def get_many(self, record_ids, *args, **kwargs):
+        '''
+        Retrieves several records.
+
+        The default implementation calls get once per record, drivers should
+        override it with a bulk request where the external system allows.
+
+        Inputs:
+            * record_ids: iterable of record ids
+            * any further arguments are passed to get
+
+        Output:
+            OrderedDict {record_id: record} in the order of record_ids, records
+            that do not exist map to None
+        '''
+        records = OrderedDict()
+        for record_id in record_ids:
+            try:
+                records[record_id] = self.get(record_id, *args, **kwargs)
+            except RecordDoesNotExist:
+                records[record_id] = None
+        return records
+
+    def create_many(self, record_id_prefix, record_id_validator, items,
+                    *args, **kwargs):
+        '''
+        Creates several records.
+
+        The default implementation calls create once per item.
+
+        Inputs:
+            * record_id_prefix, record_id_validator: as for create
+            * items: list of dicts of per record keyword arguments for create,
+                e.g. [{'record_id': 'A'}, {'record_id': 'B'}]
+            * any further arguments are passed to every create call
+
+        Output:
+            List of the ids of the created records, in the order of items
+        '''
+        created = []
+        for item in items:
+            item_kwargs = dict(kwargs)
+            item_kwargs.update(item)
+            created.append(self.create(
+                record_id_prefix, record_id_validator, *args, **item_kwargs))
+        return created
+
+    def update_many(self, items, *args, **kwargs):
+        '''
+        Updates several records.
+
+        The default implementation calls update once per item.
+
+        Inputs:
+            * items: list of dicts of per record keyword arguments for update
+            * any further arguments are passed to every update call
+
+        Output:
+            List of the results of update, in the order of items
+        '''
+        results = []
+        for item in items:
+            item_kwargs = dict(kwargs)
+            item_kwargs.update(item)
+            results.append(self.update(*args, **item_kwargs))
+        return results
+
     def create_random_record_id(self, size=9,
                                 chars=string.ascii_uppercase + string.digits,
                                 validator_func=None, max_attempts=10):
@@ -200,45 +269,331 @@ class Driver(object, metaclass=ABCMeta):
         None
 
 
+class GovernorSlot(object):
+    '''
+    The in flight slot a request holds on a governor, released at most once
+    '''
+
+    def __init__(self, governor):
+        self.governor = governor
+        # the slot is counted against the thread that acquired it
+        self.owner = threading.get_ident()
+        self._held = True
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if not self._held:
+                return
+            self._held = False
+        self.governor.release(self.owner)
+
+
+class GovernedResponse(object):
+    '''
+    Wraps an HTTPResponse so that the governor slot of its request is only
+    released once the body has been read to the end or the response is
+    closed (or garbage collected), so streamed bodies count as in flight.
+    '''
+
+    def __init__(self, response, slot):
+        self._response = response
+        self._slot = slot
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _read(self, method, amt):
+        try:
+            data = method() if amt is None else method(amt)
+        except Exception:
+            self._slot.release()
+            raise
+        if amt is None or amt < 0 or (amt and not data):
+            self._slot.release()
+        return data
+
+    def read(self, amt=None):
+        return self._read(self._response.read, amt)
+
+    def readline(self, amt=None):
+        line = self._response.readline() if amt is None else \
+            self._response.readline(amt)
+        if not line:
+            self._slot.release()
+        return line
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._slot.release()
+
+    def __del__(self):
+        slot = self.__dict__.get('_slot')
+        if slot:
+            slot.release()
+
+
+class DecodedResponse(object):
+    '''
+    Wraps an HTTPResponse whose body was sent with a gzip or deflate
+    Content-Encoding so that read() returns the decoded body. Decoding is
+    incremental, read(amt) only inflates as much of the body as is needed, so
+    large exports can be streamed. Every method reading the body (read,
+    read1, readinto, readline, readlines, peek and iteration) reads the
+    decoded body, other attributes are those of the response.
+    '''
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, response, encoding):
+        self._response = response
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        self._started = False
+        self._buffer = b''
+        self._eof = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _decode(self, data):
+        try:
+            decoded = self._decoder.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate streams without the zlib header
+            if self._started or self._encoding != 'deflate':
+                raise
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self._decoder.decompress(data)
+        self._started = True
+        return decoded
+
+    def _fill(self, data):
+        if data:
+            self._buffer += self._decode(data)
+        else:
+            self._buffer += self._decoder.flush()
+            self._eof = True
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            if not self._eof:
+                self._fill(self._response.read())
+            if not self._eof:
+                self._fill(b'')
+            data, self._buffer = self._buffer, b''
+            return data
+        while len(self._buffer) < amt and not self._eof:
+            self._fill(self._response.read(self.CHUNK_SIZE))
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def read1(self, amt=-1):
+        return self.read(amt if amt and amt > 0 else self.CHUNK_SIZE)
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    readinto1 = readinto
+
+    def peek(self, n=1):
+        while not self._buffer and not self._eof:
+            self._fill(self._response.read(self.CHUNK_SIZE))
+        return self._buffer
+
+    def readline(self, limit=-1):
+        if limit is None or limit < 0:
+            limit = None
+        while (
+            b'\n' not in self._buffer and not self._eof and
+            (limit is None or len(self._buffer) < limit)
+        ):
+            self._fill(self._response.read(self.CHUNK_SIZE))
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if limit is not None:
+            end = min(end, limit)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def readlines(self, hint=-1):
+        lines = []
+        size = 0
+        for line in self:
+            lines.append(line)
+            size += len(line)
+            if hint is not None and 0 < hint <= size:
+                break
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def readable(self):
+        return True
+
+
 class RequestHandler(object):
     '''
     The Request Handler object is designed to allow making multiple requests
     from a fixed host
+
+    Responses are requested with gzip/deflate encoding and decoded
+    transparently. Setting compress_requests to True will gzip request bodies
+    of at least compress_min_size bytes; only enable this for servers that
+    accept compressed request bodies.
+
+    A handler may be shared between threads, the per call state
+    (lastrequestbody, currentConnection) is kept per thread and headers
+    passed in are never modified.
     '''
+    ACCEPT_ENCODING = 'gzip, deflate'
+    DECODED_ENCODINGS = ('gzip', 'deflate')
+    compress_requests = False
+    compress_min_size = 64 * 1024
 
     def __init__(self, host, secure=False):
         self.host = host
         self.secure = secure
-        self.lastrequestbody = ''
-        self.currentConnection = None
+        self.governor = None
+        # per call state is kept per thread so a handler can be shared
+        self._local = threading.local()
+
+    @property
+    def lastrequestbody(self):
+        return getattr(self._local, 'lastrequestbody', '')
+
+    @lastrequestbody.setter
+    def lastrequestbody(self, value):
+        self._local.lastrequestbody = value
+
+    @property
+    def currentConnection(self):
+        return getattr(self._local, 'currentConnection', None)
+
+    @currentConnection.setter
+    def currentConnection(self, value):
+        self._local.currentConnection = value
 
     FORMAT_JSON = 'json'
     FORMAT_XML = 'xml'
     FORMAT_CSV = 'csv'
 
-    def sendRequest(self, verb, path='', headers='', body=''):
+    def throttle_key(self):
+        '''
+        Key used to share a rate limit governor between handlers, drivers
+        should override this to include their credential
+        '''
+        return (self.host,)
 
-        self.closeConnection()
-        self.lastrequestbody = body
+    def throttle(self, rate=None, burst=None, max_in_flight=None,
+                 max_retries=3, lock_dir=None, acquire_timeout=None):
+        '''
+        Rate limits requests made by this handler. The limit is shared with
+        every other handler in the process using the same throttle_key.
 
-        if(self.secure):
-            c = http.client.HTTPSConnection(self.host)
-        else:
-            c = http.client.HTTPConnection(self.host)
+        Inputs:
+            * rate: requests per second
+            * burst: number of requests allowed back to back
+            * max_in_flight: number of concurrent requests allowed
+            * max_retries: retries after a 429 (Too Many Requests) response
+            * lock_dir: directory used to share the rate limit with other
+                processes on this host
+            * acquire_timeout: seconds a request waits for an in flight slot
+                before InFlightLimitError is raised, None to wait
+                indefinitely
+
+        A request made while the same thread holds every in flight slot
+        (e.g. while still iterating a streamed response) raises
+        InFlightLimitError instead of waiting forever.
+        '''
+        self.governor = get_governor(
+            self.throttle_key(), rate=rate, burst=burst,
+            max_in_flight=max_in_flight, max_retries=max_retries,
+            lock_dir=lock_dir, acquire_timeout=acquire_timeout)
+        return self.governor
 
-        ts = datetime.datetime.now()
+    def retryAfter(self, response, attempt):
+        try:
+            return max(float(response.getheader('Retry-After')), 0)
+        except (TypeError, ValueError):
+            return 2 ** attempt
+
+    def encodeRequest(self, headers, body):
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', self.ACCEPT_ENCODING)
+        if (
+            self.compress_requests and
+            body and
+            len(body) >= self.compress_min_size
+        ):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return headers, body
+
+    def decodeResponse(self, response):
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding in self.DECODED_ENCODINGS:
+            return DecodedResponse(response, encoding)
+        return response
 
-        c.request(verb, path, body, headers)
+    def sendRequest(self, verb, path='', headers='', body=''):
 
-        log.debug(
-            "datasource request ({0}) {1}ms".format(
-                path,
-                (datetime.datetime.now() - ts).microseconds/1000)
-        )
+        # http.client pulls in the email package, import it on first use
+        import http.client
 
-        r = c.getresponse()
+        self.lastrequestbody = body
+        headers, body = self.encodeRequest(headers, body)
+        governor = self.governor
+        attempt = 0
 
-        return r
+        while True:
+            if(self.secure):
+                c = http.client.HTTPSConnection(self.host)
+            else:
+                c = http.client.HTTPConnection(self.host)
+            self.currentConnection = c
+
+            ts = datetime.datetime.now()
+
+            slot = None
+            if governor:
+                governor.acquire()
+                slot = self._local.slot = GovernorSlot(governor)
+            try:
+                c.request(verb, path, body, headers)
+                r = c.getresponse()
+            except Exception:
+                if slot:
+                    slot.release()
+                raise
+
+            log.debug(
+                "datasource request ({0}) {1}ms".format(
+                    path,
+                    (datetime.datetime.now() - ts).microseconds/1000)
+            )
+
+            if governor and r.status == 429 and attempt < governor.max_retries:
+                governor.backoff(self.retryAfter(r, attempt))
+                r.read()
+                c.close()
+                slot.release()
+                attempt += 1
+                continue
+
+            if slot:
+                # the slot is held until the body has been read
+                r = GovernedResponse(r, slot)
+            return self.decodeResponse(r)
 
     def POST(self, path='', headers='', body=''):
         self.lastrequestbody = body
@@ -255,6 +610,11 @@ class RequestHandler(object):
     def closeConnection(self):
         if self.currentConnection:
             self.currentConnection.close()
+            self.currentConnection = None
+        slot = getattr(self._local, 'slot', None)
+        if slot:
+            slot.release()
+            self._local.slot = None
 
     def processResponse(self, response, path=''):
         status = response.status
@@ -309,7 +669,8 @@ class RequestHandler(object):
             if _format == self.FORMAT_JSON:
                 return self.raw_to_json(responseString)
             if _format == self.FORMAT_XML:
-                return xml.parseString(responseString)
+                from xml.dom import minidom
+                return minidom.parseString(responseString)
             return responseString
         except Exception:
             # TODO: Pass up some informative error
@@ -0,0 +1,176 @@
+'''
+Small in-process caches shared by the drivers.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from .singleflight import SingleFlight
+
+
+class TTLCache(object):
+    '''
+    Thread safe, size bounded (least recently used entries are evicted first)
+    cache whose entries expire `ttl` seconds after they are set.
+
+    Values loaded outside the cache can be stored with the version taken
+    before loading them (see version), set then drops them if their key was
+    invalidated in the meantime, so a load racing a write cannot put the
+    pre-write value back.
+    '''
+
+    def __init__(self, ttl, maxsize=128, timer=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every invalidation. _invalidated holds the clock of the
+        # latest invalidation of (at most maxsize) keys, versions older than
+        # _floor are stale for every key.
+        self._clock = 0
+        self._floor = 0
+        self._invalidated = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def version(self):
+        '''
+        Returns the version to pass to set for a value loaded after this call
+        '''
+        with self._lock:
+            return self._clock
+
+    def set(self, key, value, version=None):
+        '''
+        Stores value for key, unless version is given and key has been
+        invalidated since it was taken. Returns True if value was stored.
+        '''
+        with self._lock:
+            if version is not None and (
+                version < self._floor or
+                self._invalidated.get(key, -1) > version
+            ):
+                return False
+            self._data[key] = (self.timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def _invalidate_all(self):
+        self._clock += 1
+        self._floor = self._clock
+        self._invalidated.clear()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._clock += 1
+            self._invalidated[key] = self._clock
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self.maxsize:
+                # forgetting a key's invalidation makes every older version
+                # stale instead
+                _, clock = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, clock)
+
+    def invalidate_where(self, predicate):
+        '''
+        Removes every entry whose key satisfies predicate(key). Values being
+        loaded for keys that are not stored yet cannot be matched, so every
+        outstanding version becomes stale.
+        '''
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+            self._invalidate_all()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._invalidate_all()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class RefreshingCache(object):
+    '''
+    Cache of loaded values that are fresh for `ttl` seconds and are then
+    served stale for up to `stale_ttl` further seconds while a background
+    thread reloads them (stale-while-revalidate). Missing and expired values
+    are loaded by the caller, concurrent loads of a key are coalesced.
+    '''
+
+    def __init__(self, ttl, stale_ttl=0, maxsize=128, timer=time.monotonic):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timer = timer
+        self._cache = TTLCache(ttl + stale_ttl, maxsize, timer)
+        self._loads = SingleFlight()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _load(self, key, load):
+        # values loaded from before an invalidation are not stored
+        version = self._cache.version()
+        value = load()
+        self._cache.set(key, (self.timer(), value), version)
+        return value
+
+    def _refresh(self, key, load):
+        try:
+            self._load(key, load)
+        except Exception:
+            # keep serving the stale value, the next expired get retries
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, key, load):
+        '''
+        Returns the cached value for key, calling load() to obtain it if
+        there is none. A stale value is returned as is and reloaded in the
+        background.
+        '''
+        entry = self._cache.get(key)
+        if entry is None:
+            return self._loads.do(key, self._load, key, load)
+        loaded, value = entry
+        if self.timer() - loaded >= self.ttl:
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                threading.Thread(
+                    target=self._refresh, args=(key, load), daemon=True
+                ).start()
+        return value
+
+    def invalidate(self, key):
+        self._cache.invalidate(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
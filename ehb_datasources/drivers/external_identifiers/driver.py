@@ -4,8 +4,6 @@ from ehb_datasources.drivers.Base import Driver, RequestHandler
 from ehb_datasources.drivers.exceptions import RecordCreationError, \
     IgnoreEhbExceptions
 
-from jinja2 import Template
-
 
 class ehbDriver(Driver, RequestHandler):
 
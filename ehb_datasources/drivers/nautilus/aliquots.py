@@ -0,0 +1,347 @@
+'''
+Normalisation of the aliquots in NauREST SDG responses.
+
+The raw aliquots are dicts of ~90 string fields. normalize_aliquots walks
+an SDG once and turns each aliquot into a compact Aliquot tuple holding only
+what the biorepository views use, with typed dates.
+'''
+import datetime
+import logging
+from collections import namedtuple
+
+log = logging.getLogger(__file__)
+
+SAMPLE_TYPES = {
+    'TISS': 'Tissue',
+    'BLD': 'Blood',
+    'BMA': 'Bone Marrow Aspirate',
+    'BMC': 'Bone Marrow Cells',
+    'DNA': 'DNA',
+    'TUM': 'Tumor Tissue',
+    'PBMC': 'PBMC',
+    'PHER': 'Pheresate',
+    'RNA': 'RNA',
+    'CSF': 'Cerebral Spinal Fluid',
+    'BMLC': 'Bone Marrow Cells - Left',
+    'BMCL': 'Bone Marrow Cells',
+    'BMRC': 'Bone Marrow Cells - Right',
+    'BSWB': 'Buccal Swab',
+    'PLAS': 'Plasma',
+    'PLF': 'Pleural Fluid',
+    'PHC': 'Apheresis Cells',
+    'CELN': 'Cell Line',
+    'CELLFRZ': 'Cell Freeze',
+    'SAL': 'Saliva',
+    'SER': 'Serum',
+    'SLD': 'Slide',
+    'LYS': 'Lysate',
+    'XEN': 'Xenograft',
+    'PROT': 'Protein',
+    'QC-GEL': 'QC Gel',
+    'QC-Xpose': 'QC Xpose',
+    'QC-AGIL': 'QC Agilent'
+}
+
+SECONDARY_SAMPLE_TYPES = {
+    'CELC': 'Cell Culture',
+    'CYSF': 'Cyst Fluid',
+    'FFRZ': 'Flash Frozen',
+    'FRZM': 'Freezing Media',
+    'DNA': 'DNA',
+    'LEFT': 'Left',
+    'RIGHT': 'Right',
+    'MAT': 'Maternal',
+    'PAT': 'Paternal',
+    'SUP': 'Supernant',
+    'CELP': 'Cell Pellet',
+    'FFPE': 'FFPE',
+    'CRYO': 'CRYO',
+    'EDTA': 'EDTA'
+}
+
+STATUS_UNRECEIVED = '<p class="text-warning"><em>Unreceived</em></p>'
+STATUS_CANCELLED = '<p class="text-danger"><em>Cancelled</em></p>'
+STATUS_DISPOSED = '<p class="text-warning"><em>Disposed</em></p>'
+STATUS_AVAILABLE = '<p class="text-success"><em>Available</em></p>'
+RECEIVED_STATUSES = frozenset(('V', 'C', 'P'))
+
+DATETIME_FORMAT = '%d %m %Y %H:%M:%S'
+
+Aliquot = namedtuple('Aliquot', [
+    'name',
+    'sample_type',
+    'secondary_sample_type',
+    'label',
+    'status',
+    'status_html',
+    'is_received',
+    'is_disposed',
+    'collected',
+    'received',
+])
+_new_tuple = tuple.__new__
+
+
+def parse_datetime(value):
+    '''
+    Parses a NauREST 'DD MM YYYY HH:MM:SS' timestamp, returns None if value
+    is not one. Zero padded values (the norm) are sliced directly, anything
+    else falls back to strptime.
+    '''
+    try:
+        if (
+            len(value) == 19 and
+            value[2] == value[5] == value[10] == ' ' and
+            value[13] == value[16] == ':'
+        ):
+            return datetime.datetime(
+                int(value[6:10]), int(value[3:5]), int(value[0:2]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return [value]
+    return []
+
+
+def raw_aliquots(sample_data):
+    '''
+    Returns the aliquot dicts of an SDG whose SAMPLE and ALIQUOT members may
+    each be a single dict or a list
+    '''
+    try:
+        samples = sample_data['SDG']['SAMPLE']
+    except (KeyError, TypeError):
+        return []
+    aliquots = []
+    for sample in _as_list(samples):
+        aliquots.extend(_as_list(sample.get('ALIQUOT')))
+    return aliquots
+
+
+def sample_label(sample_type, secondary_sample_type):
+    primary = SAMPLE_TYPES.get(sample_type)
+    if primary is None:
+        log.debug('Unable to find sample mapping for {0}'.format(sample_type))
+        primary = ''
+    secondary = SECONDARY_SAMPLE_TYPES.get(secondary_sample_type)
+    if secondary is None:
+        if secondary_sample_type:
+            log.debug('Unable to find secondary sample mapping for {0}'.format(
+                secondary_sample_type))
+        secondary = ''
+    return '{0} {1}'.format(primary, secondary).rstrip(' ')
+
+
+def normalize(aliquot, labels=None, dates=None):
+    '''
+    Converts a raw aliquot dict to an Aliquot. labels and dates are optional
+    dicts used to memoise sample labels and parsed timestamps across calls.
+    '''
+    if labels is None:
+        labels = {}
+    if dates is None:
+        dates = {}
+    get = aliquot.get
+    sample_type = get('U_SAMPLE_TYPE', '')
+    secondary_sample_type = get('U_SECONDARY_SAMPLE_TYPE', '')
+    label_key = (sample_type, secondary_sample_type)
+    label = labels.get(label_key)
+    if label is None:
+        label = labels[label_key] = sample_label(
+            sample_type, secondary_sample_type)
+    status = get('STATUS', '')
+    is_received = status in RECEIVED_STATUSES
+    is_disposed = is_received and get('U_DISPOSED') == 'T'
+    collected = received = None
+    if status == 'U':
+        status_html = STATUS_UNRECEIVED
+    elif status == 'X':
+        status_html = STATUS_CANCELLED
+    elif is_received:
+        status_html = STATUS_DISPOSED if is_disposed else STATUS_AVAILABLE
+        value = get('U_COLLECT_DATE_TIME')
+        try:
+            collected = dates[value]
+        except KeyError:
+            collected = dates[value] = parse_datetime(value)
+        except TypeError:
+            collected = None
+        value = get('U_RECEIVED_DATE_TIME')
+        try:
+            received = dates[value]
+        except KeyError:
+            received = dates[value] = parse_datetime(value)
+        except TypeError:
+            received = None
+    else:
+        status_html = status
+    # tuple.__new__ skips the argument handling of Aliquot.__new__
+    return _new_tuple(Aliquot, (
+        get('NAME', ''),
+        sample_type,
+        secondary_sample_type,
+        label,
+        status,
+        status_html,
+        is_received,
+        is_disposed,
+        collected,
+        received,
+    ))
+
+
+def normalize_aliquots(sample_data):
+    '''
+    Returns the aliquots of an SDG (as returned by get_sample_data) as a
+    list of Aliquot. Labels and timestamps, which aliquots of a sample
+    share, are only computed once per SDG.
+    '''
+    labels, dates = {}, {}
+    return [
+        normalize(aliquot, labels, dates)
+        for aliquot in raw_aliquots(sample_data)
+    ]
+
+
+def status_category(aliquot):
+    '''
+    Returns one of 'unreceived', 'cancelled', 'disposed', 'available' or
+    None for an Aliquot
+    '''
+    if aliquot.status == 'U':
+        return 'unreceived'
+    if aliquot.status == 'X':
+        return 'cancelled'
+    if aliquot.is_received:
+        return 'disposed' if aliquot.is_disposed else 'available'
+    return None
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime.datetime) or value is None:
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time.min)
+    return parse_datetime(value)
+
+
+def as_bool(value):
+    '''
+    Converts a flag that may come from request parameters ('true', 'false',
+    '1', '0', 'yes', 'no', 'on', 'off', '') to a bool
+    '''
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes', 'on')
+    return bool(value)
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return frozenset((value,))
+    return frozenset(value)
+
+
+def filter_aliquots(aliquots, sample_types=None, statuses=None,
+                    received_after=None, received_before=None):
+    '''
+    Returns the Aliquots matching every given criterion.
+
+    Inputs:
+    sample_types: sample type code or codes (e.g. 'BLD' or ['BLD', 'DNA'])
+    statuses: status category or categories (see status_category)
+    received_after: date or datetime, keeps aliquots received at or after it
+    received_before: date or datetime, keeps aliquots received before it
+
+    Aliquots without a received date never match a received date filter.
+    '''
+    sample_types = _as_set(sample_types)
+    statuses = _as_set(statuses)
+    received_after = _as_datetime(received_after)
+    received_before = _as_datetime(received_before)
+    by_received = received_after is not None or received_before is not None
+    matched = []
+    for aliquot in aliquots:
+        if sample_types and aliquot.sample_type not in sample_types:
+            continue
+        if statuses and status_category(aliquot) not in statuses:
+            continue
+        if by_received:
+            received = aliquot.received
+            if received is None:
+                continue
+            if received_after is not None and received < received_after:
+                continue
+            if received_before is not None and received >= received_before:
+                continue
+        matched.append(aliquot)
+    return matched
+
+
+SORT_KEYS = {
+    'name': lambda aliquot: aliquot.name,
+    'label': lambda aliquot: aliquot.label,
+    'sample_type': lambda aliquot: aliquot.sample_type,
+    'status': status_category,
+    'collected': lambda aliquot: aliquot.collected,
+    'received': lambda aliquot: aliquot.received,
+}
+
+
+def sort_aliquots(aliquots, sort_by='name', descending=False):
+    '''
+    Returns the Aliquots sorted on one of SORT_KEYS. Aliquots without a
+    value to sort on (e.g. the received date of unreceived aliquots) come
+    last in either direction. descending may be a request parameter string
+    (see as_bool). Raises ValueError for an unknown sort_by.
+    '''
+    descending = as_bool(descending)
+    try:
+        key = SORT_KEYS[sort_by]
+    except KeyError:
+        raise ValueError('Cannot sort aliquots by {0}'.format(sort_by))
+    present, missing = [], []
+    for aliquot in aliquots:
+        (missing if key(aliquot) is None else present).append(aliquot)
+    present.sort(key=key, reverse=descending)
+    return present + missing
+
+
+def paginate(items, page=1, page_size=None):
+    '''
+    Returns (the items on page, page info). Pages are numbered from 1, a
+    page past the end is clamped to the last page and a page_size of None
+    (or 0) puts every item on a single page. page and page_size may be
+    request parameter strings, they are converted with int().
+
+    Outputs:
+    page info: {'page', 'page_size', 'pages', 'total', 'first', 'last'}
+    first and last being the 1-based positions of the page's items (both 0
+    if there are none).
+    '''
+    total = len(items)
+    page_size = int(page_size or 0)
+    if page_size <= 0:
+        page_size = total
+        pages = 1
+    else:
+        pages = max(1, -(-total // page_size))
+    page = min(max(1, int(page or 1)), pages)
+    start = (page - 1) * page_size
+    selected = items[start:start + page_size]
+    return selected, {
+        'page': page,
+        'page_size': page_size,
+        'pages': pages,
+        'total': total,
+        'first': start + 1 if selected else 0,
+        'last': start + len(selected),
+    }
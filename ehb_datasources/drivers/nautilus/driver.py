@@ -1,22 +1,57 @@
 import base64
-import datetime
 import json
 import logging
 import os
-import codecs
 from collections import OrderedDict
-import urllib.request, urllib.parse, urllib.error
-
-from jinja2 import Template
+from concurrent.futures import ThreadPoolExecutor
 
 from ehb_datasources.drivers.Base import Driver, RequestHandler
+from ehb_datasources.drivers.cache import RefreshingCache, TTLCache
+from ehb_datasources.drivers.nautilus import aliquots
+from ehb_datasources.drivers.nautilus import response as nau_response
 from ehb_datasources.drivers.exceptions import RecordCreationError, \
     IgnoreEhbExceptions
 
 log = logging.getLogger(__file__)
 
 
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+_templates = None
+
+
+def get_template(name):
+    '''
+    Returns the compiled template name from TEMPLATE_DIR. Templates are
+    compiled once per process.
+    '''
+    global _templates
+    if _templates is None:
+        from jinja2 import Environment, FileSystemLoader
+        _templates = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return _templates.get_template(name)
+
+
+class SampleDataError(Exception):
+    # carries an error result past the aliquot cache so it is not stored
+    def __init__(self, result):
+        self.result = result
+
+
 class ehbDriver(Driver, RequestHandler):
+    '''
+    Nautilus (NauREST) driver for the eHB.
+
+    If aliquot_cache_ttl (seconds) is supplied the processed aliquot lists
+    returned by get_aliquots are cached per SDG name (at most
+    aliquot_cache_size SDGs). Once older than aliquot_cache_ttl a list is
+    still served for up to aliquot_stale_ttl seconds while it is refreshed in
+    the background. Updates made through this driver drop the SDG's entry.
+
+    If missing_sdg_ttl (seconds) is supplied, SDG names NauREST reports as
+    unknown (404) are remembered for that long (at most missing_sdg_cache_size
+    names) and get_sample_data answers them without a request until the SDG
+    is updated through this driver.
+    '''
 
     FORM_SDG_ID = 'SDG_ID'
     FORM_SDG_NAME = 'SDG_NAME'
@@ -39,8 +74,18 @@ class ehbDriver(Driver, RequestHandler):
         '101': 'NAU invalid authorization header.',
         '500': 'server error.'
     }
-
-    def __init__(self, url, user, password, secure):
+    UPDATE_BATCH_SIZE = 100
+    UPDATE_BATCH_BYTES = 256 * 1024
+    SAMPLE_DATA_WORKERS = 8
+    # aliquots rendered per page by subRecordSelectionForm, None for all
+    ALIQUOT_PAGE_SIZE = None
+    ALIQUOT_PAGE_OPTIONS = (
+        'page', 'page_size', 'sort_by', 'descending', 'sample_types',
+        'statuses', 'received_after', 'received_before')
+
+    def __init__(self, url, user, password, secure, aliquot_cache_ttl=None,
+                 aliquot_stale_ttl=0, aliquot_cache_size=256,
+                 missing_sdg_ttl=None, missing_sdg_cache_size=1024):
         def getHost(url):
             return url.split('/')[2]
 
@@ -60,6 +105,15 @@ class ehbDriver(Driver, RequestHandler):
 
         RequestHandler.__init__(self, host=host, secure=secure)
 
+        self.aliquot_cache = None
+        if aliquot_cache_ttl:
+            self.aliquot_cache = RefreshingCache(
+                aliquot_cache_ttl, aliquot_stale_ttl, aliquot_cache_size)
+        self.missing_sdgs = None
+        if missing_sdg_ttl:
+            self.missing_sdgs = TTLCache(
+                missing_sdg_ttl, missing_sdg_cache_size)
+
     def find_nau_elem_identifier(self, dict_):
         for vid in self.VALID_NAU_ELEM_IDENTIFIERS:
             ident = dict_.get(vid)
@@ -67,6 +121,9 @@ class ehbDriver(Driver, RequestHandler):
                 return (vid, ident)
         return (None, None)
 
+    def throttle_key(self):
+        return (self.host, self.username)
+
     def encode_nau_creds(self):
         creds = base64.b64encode(bytes('{0}:{1}'.format(self.username, self.password), 'utf-8'))
         return 'Basic {0}'.format(creds.decode('utf-8'))
@@ -93,18 +150,132 @@ class ehbDriver(Driver, RequestHandler):
                 submitted to http://naurest.com/api/sample and the proper
                 value for this input is 'sample'
         '''
-        fldvals = kwargs.get('fldvals', {})
+        update = self.update_item(kwargs)
+        try:
+            return self.put_items(kwargs.get('nau_sub_path', ''), [update])
+        finally:
+            self.invalidate_aliquots([update])
+
+    def update_many(self, items, *args, **kwargs):
+        '''
+        Submits several updates to the Nautilus-REST service, NauREST accepts
+        a list of updates so they are sent in as few requests as possible:
+        each request holds at most batch_size (default UPDATE_BATCH_SIZE)
+        updates and UPDATE_BATCH_BYTES bytes of JSON.
+
+        Inputs:
+            * items : list of dicts each containing an identifier (see
+                VALID_NAU_ELEM_IDENTIFIERS) and fldvals, as for update
+            * nau_sub_path (kwargs) : as for update
+            * batch_size (kwargs)
+
+        Output: list with one result per item, in the order of items. Each
+        result is the status NauREST returned for the item (a dict with at
+        least 'status') with an added 'error' key: None if the status is
+        200, otherwise the NAU_ERROR_MAP message for the status. If a whole
+        request fails every item in it gets the request's error.
+        '''
         nau_sub_path = kwargs.get('nau_sub_path', '')
+        batch_size = kwargs.get('batch_size') or self.UPDATE_BATCH_SIZE
+        updates = [self.update_item(item) for item in items]
+        results = []
+        try:
+            for batch in self.update_batches(updates, batch_size):
+                response = self.put_raw(nau_sub_path, batch)
+                results.extend(self.update_results(batch, response))
+        finally:
+            self.invalidate_aliquots(updates)
+        return results
+
+    def invalidate_aliquots(self, updates):
+        '''
+        Drops the cached aliquots and cached misses of the SDGs touched by
+        updates (see update_item). Updates that do not identify an SDG by
+        name clear both caches.
+        '''
+        caches = [
+            cache for cache in (self.aliquot_cache, self.missing_sdgs)
+            if cache is not None
+        ]
+        for update in updates:
+            if self.NAU_REC_NAME in update:
+                for cache in caches:
+                    cache.invalidate(update[self.NAU_REC_NAME])
+            else:
+                for cache in caches:
+                    cache.clear()
+                return
+
+    def update_batches(self, updates, batch_size):
+        '''
+        Splits updates into lists of at most batch_size updates whose JSON
+        encoding is at most UPDATE_BATCH_BYTES long (an update larger than
+        that is sent on its own)
+        '''
+        batch, size = [], 2
+        for update in updates:
+            item_size = len(json.dumps(update)) + 2
+            if batch and (
+                len(batch) == batch_size or
+                size + item_size > self.UPDATE_BATCH_BYTES
+            ):
+                yield batch
+                batch, size = [], 2
+            batch.append(update)
+            size += item_size
+        if batch:
+            yield batch
+
+    def update_status(self, status, **values):
+        status = '' if status is None else str(status)
+        result = dict(values)
+        result['status'] = status
+        result['error'] = None if status == '200' else \
+            self.NAU_ERROR_MAP.get(status, 'UNKNOWN ERROR')
+        return result
+
+    def update_results(self, batch, response):
+        '''
+        Maps the response to a batch of updates to one result per update,
+        see update_many
+        '''
+        result = self.read_result(response)
+        if result.status not in nau_response.SUCCESS_STATUSES:
+            log.error('Nautilus update failed with status {0}'.format(
+                result.status))
+            return [self.update_status(result.status) for u in batch]
+        if result.error_code is not None:
+            # request level error, e.g. {"error": "1"}
+            return [self.update_status(result.error_code) for u in batch]
+        statuses = result.payload
+        if not isinstance(statuses, list):
+            log.error('Unable to parse Nautilus update response: '
+                      '{0!r}'.format(statuses))
+            return [self.update_status('') for u in batch]
+        results = []
+        for i, update in enumerate(batch):
+            if i < len(statuses) and isinstance(statuses[i], dict):
+                values = dict(statuses[i])
+                results.append(self.update_status(
+                    values.pop('status', None), **values))
+            else:
+                results.append(self.update_status(''))
+        return results
+
+    def update_item(self, kwargs):
         rec_key, rec_id = self.find_nau_elem_identifier(kwargs)
         # Using OrderedDict for test reproducibility.
-        params = OrderedDict([
+        return OrderedDict([
             (rec_key, rec_id),
-            ("fldvals", fldvals)
+            ("fldvals", kwargs.get('fldvals', {}))
         ])
-        body = [
-            params
-        ]
-        body = json.dumps(body)
+
+    def put_items(self, nau_sub_path, items):
+        return self.processResponse(
+            self.put_raw(nau_sub_path, items), self.path)
+
+    def put_raw(self, nau_sub_path, items):
+        body = json.dumps(items)
         nau_creds = self.encode_nau_creds()
         headers = {
             'Accept': 'application/json',
@@ -114,15 +285,18 @@ class ehbDriver(Driver, RequestHandler):
         full_path = self.path + nau_sub_path
         if not full_path.endswith('/'):
             full_path += '/'
-        response = self.PUT(full_path, headers, body)
-        processed_response = self.processResponse(response, self.path)
-        return processed_response
+        return self.PUT(full_path, headers, body)
 
     def get_sample_data(self, *args, **kwargs):
         '''
         This will submit a request to the Nautilus-REST service to retrieve
         sample information.
         '''
+        record_id = kwargs.get('record_id')
+        if self.missing_sdgs is not None:
+            missing = self.missing_sdgs.get(record_id)
+            if missing is not None:
+                return self.sample_data(record_id, missing)
         body = ''
         nau_creds = self.encode_nau_creds()
         headers = {
@@ -133,154 +307,157 @@ class ehbDriver(Driver, RequestHandler):
         full_path = self.path + 'sdg'
         if not full_path.endswith('/'):
             full_path += '/'
-        full_path += '?name={sdg}'.format(sdg=kwargs.get('record_id'))
-        response = self.GET(full_path, headers, body)
-        if (response.status != 200):
-            if (response.status == 401):
-                log.error('Error: Nautilus Authentication error')
-                return {"error": "Nautilus Authentication error. Please e-mail BioRC@email.chop.edu, EiGSupport@email.chop.edu and your research coordinator to resolve"}
-            elif(response.status == 404):
-                log.error('Error: SDG name {sdg} does not exist in Nautilus'.format(sdg=kwargs.get('record_id')))
-                return{"error": "SDG name {sdg} does not exist in Nautilus. Please e-mail BioRC@email.chop.edu if this SDG should exist.".format(sdg=kwargs.get('record_id'))}
-            else:
-                log.error('Error with Nautilus Webservice')
-                return {"error": "Error with Nautilus Webservice. Please e-mail BioRC@email.chop.edu, EiGSupport@email.chop.edu and your research coordinator to resolve"}
-        try:
-            return json.loads(response.read().decode('utf-8'))[0]
-        except KeyError:
-            try:  # grab error number and process error
-                responseDict = json.loads(response.read().decode('utf-8'))
-                status = responseDict['error']
-                errorMsg = self.NAU_ERROR_MAP.get(status, 'UNKNOWN ERROR')
-                log.error(errorMsg)
-                return {"error": errorMsg}
-            except (KeyError, TypeError):
-                log.error('Error retrieving sample data')
-                return {"error": "Unable to retrieve sample data."}
-        except IndexError:
-            if (response == '[]'):
-                log.error('Zero samples returned, This SDG does exist in Nautilus but it does not have any aliquots alligned to it.')
-                return {"warning": "Zero samples returned, This SDG does exist in Nautilus but it does not have any aliquots aligned to it. reach out to the BioRC if this is unexpected. <a href=\"mailto:BioRC@email.chop.edu\"> BioRC@email.chop.edu"}
-            else:
-                log.error('Error retrieving sample data.')
-                return {"error": "Unable to retrieve sample data. Please contact the data coordinating center or <a href=\"mailto:eigsupport@email.chop.edu\"> eigsupport@email.chop.edu"}
-        except:
-            log.error('Error retrieving sample data')
-            return {"error": "Unable to retrieve sample data. Please contact the data coordinating center or <a href=\"mailto:eigsupport@email.chop.edu\"> eigsupport@email.chop.edu"}
+        full_path += '?name={sdg}'.format(sdg=record_id)
+        if self.missing_sdgs is not None:
+            missing_version = self.missing_sdgs.version()
+        result = self.read_result(self.GET(full_path, headers, body))
+        if self.missing_sdgs is not None and \
+                result.kind == nau_response.NOT_FOUND:
+            self.missing_sdgs.set(record_id, result, missing_version)
+        return self.sample_data(record_id, result)
+
+    def read_result(self, response):
+        '''
+        Reads and decodes the body of a NauREST response once, closing the
+        connection, and returns its nau_response.NauResult
+        '''
+        body = None
+        if response.status in nau_response.SUCCESS_STATUSES:
+            try:
+                body = response.read()
+            except Exception:
+                log.exception('Unable to read Nautilus response')
+        self.closeConnection()
+        return nau_response.parse(response.status, body)
+
+    def sample_data(self, record_id, result):
+        '''
+        Maps the NauResult of an SDG request to the sample data of the SDG
+        named record_id, or to an {"error": ...} or {"warning": ...} dict
+        '''
+        kind = result.kind
+        if kind == nau_response.OK and isinstance(result.payload, list):
+            return result.payload[0]
+        if kind == nau_response.UNAUTHORIZED:
+            log.error('Error: Nautilus Authentication error')
+            return {"error": "Nautilus Authentication error. Please e-mail BioRC@email.chop.edu, EiGSupport@email.chop.edu and your research coordinator to resolve"}
+        if kind == nau_response.NOT_FOUND:
+            log.error('Error: SDG name {sdg} does not exist in Nautilus'.format(sdg=record_id))
+            return{"error": "SDG name {sdg} does not exist in Nautilus. Please e-mail BioRC@email.chop.edu if this SDG should exist.".format(sdg=record_id)}
+        if kind == nau_response.HTTP_ERROR:
+            log.error('Error with Nautilus Webservice')
+            return {"error": "Error with Nautilus Webservice. Please e-mail BioRC@email.chop.edu, EiGSupport@email.chop.edu and your research coordinator to resolve"}
+        if kind == nau_response.NAU_ERROR:
+            errorMsg = self.NAU_ERROR_MAP.get(result.error_code, 'UNKNOWN ERROR')
+            log.error(errorMsg)
+            return {"error": errorMsg}
+        if kind == nau_response.EMPTY:
+            log.error('Zero samples returned, This SDG does exist in Nautilus but it does not have any aliquots alligned to it.')
+            return {"warning": "Zero samples returned, This SDG does exist in Nautilus but it does not have any aliquots aligned to it. reach out to the BioRC if this is unexpected. <a href=\"mailto:BioRC@email.chop.edu\"> BioRC@email.chop.edu"}
+        log.error('Error retrieving sample data, unexpected response: '
+                  '{0!r}'.format(result.payload))
+        return {"error": "Unable to retrieve sample data. Please contact the data coordinating center or <a href=\"mailto:eigsupport@email.chop.edu\"> eigsupport@email.chop.edu"}
+
+    def get_sample_data_many(self, names, max_workers=None):
+        '''
+        Retrieves the sample information of several SDGs, fetching up to
+        max_workers (default SAMPLE_DATA_WORKERS) SDGs concurrently.
+
+        Output: OrderedDict {name: sample data} in the order of names, each
+        value being what get_sample_data returns for the name (including its
+        {"error": ...} and {"warning": ...} results). A request that fails
+        outright only produces an error for its own name.
+        '''
+        names = list(OrderedDict.fromkeys(names))
+
+        def fetch(name):
+            try:
+                return self.get_sample_data(record_id=name)
+            except Exception:
+                log.exception('Error retrieving sample data for {0}'.format(
+                    name))
+                return {"error": "Unable to retrieve sample data. Please contact the data coordinating center or <a href=\"mailto:eigsupport@email.chop.edu\"> eigsupport@email.chop.edu"}  # noqa
+
+        workers = min(max_workers or self.SAMPLE_DATA_WORKERS, len(names))
+        if workers <= 1:
+            return OrderedDict((name, fetch(name)) for name in names)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return OrderedDict(zip(names, pool.map(fetch, names)))
+
+    def aliquot_summary(self, sample_data):
+        '''
+        Summarises the aliquots of an SDG (as returned by get_sample_data)
+        for list views without formatting each aliquot: aliquot counts by
+        status and by sample type code, plus any error or warning.
+        '''
+        summary = {
+            'total': 0,
+            'received': 0,
+            'available': 0,
+            'disposed': 0,
+            'unreceived': 0,
+            'cancelled': 0,
+            'sample_types': {}
+        }
+        for key in ('error', 'warning'):
+            if key in sample_data:
+                summary[key] = sample_data[key]
+        for aliquot in self.extract_aliquots(sample_data):
+            summary['total'] += 1
+            sample_type = aliquot.get('U_SAMPLE_TYPE', '')
+            summary['sample_types'][sample_type] = \
+                summary['sample_types'].get(sample_type, 0) + 1
+            status = aliquot.get('STATUS')
+            if status == 'U':
+                summary['unreceived'] += 1
+            elif status == 'X':
+                summary['cancelled'] += 1
+            elif status in ('V', 'C', 'P'):
+                summary['received'] += 1
+                if aliquot.get('U_DISPOSED') == 'T':
+                    summary['disposed'] += 1
+                else:
+                    summary['available'] += 1
+        return summary
+
+    def aliquot_summary_many(self, names, max_workers=None):
+        '''
+        Returns OrderedDict {name: aliquot_summary} for several SDGs, see
+        get_sample_data_many
+        '''
+        return OrderedDict(
+            (name, self.aliquot_summary(sample_data))
+            for name, sample_data in self.get_sample_data_many(
+                names, max_workers).items())
 
     def extract_aliquots(self, sample_data):
-        aliquots = []
-        try:
-            assert type(sample_data['SDG']['SAMPLE']) is list
-            for sample in sample_data['SDG']['SAMPLE']:
-                for i in sample['ALIQUOT']:
-                    aliquots.append(i)
-            return aliquots
-        except:
-            pass
-        try:
-            assert type(sample_data['SDG']['SAMPLE']['ALIQUOT']) is dict
-            if type(sample_data['SDG']['SAMPLE']['ALIQUOT']) is dict:
-                aliquots = [sample_data['SDG']['SAMPLE']['ALIQUOT']]
-            return aliquots
-        except:
-            pass
-        try:
-            aliquots = sample_data['SDG']['SAMPLE']['ALIQUOT']
-        except:
-            pass
-        return aliquots
+        return aliquots.raw_aliquots(sample_data)
 
     def format_aliquots(self, sample_data):
-        type_map = {
-            'TISS': 'Tissue',
-            'BLD': 'Blood',
-            'BMA': 'Bone Marrow Aspirate',
-            'BMC': 'Bone Marrow Cells',
-            'DNA': 'DNA',
-            'TUM': 'Tumor Tissue',
-            'PBMC': 'PBMC',
-            'PHER': 'Pheresate',
-            'RNA': 'RNA',
-            'CSF': 'Cerebral Spinal Fluid',
-            'BMLC': 'Bone Marrow Cells - Left',
-            'BMCL': 'Bone Marrow Cells',
-            'BMRC': 'Bone Marrow Cells - Right',
-            'BSWB': 'Buccal Swab',
-            'PLAS': 'Plasma',
-            'PLF': 'Pleural Fluid',
-            'PHC': 'Apheresis Cells',
-            'CELN': 'Cell Line',
-            'CELLFRZ': 'Cell Freeze',
-            'SAL': 'Saliva',
-            'SER': 'Serum',
-            'SLD': 'Slide',
-            'LYS': 'Lysate',
-            'XEN': 'Xenograft',
-            'PROT': 'Protein',
-            'QC-GEL': 'QC Gel',
-            'QC-Xpose': 'QC Xpose',
-            'QC-AGIL': 'QC Agilent'
-        }
-        secondary_type_map = {
-            'CELC': 'Cell Culture',
-            'CYSF': 'Cyst Fluid',
-            'FFRZ': 'Flash Frozen',
-            'FRZM': 'Freezing Media',
-            'DNA': 'DNA',
-            'LEFT': 'Left',
-            'RIGHT': 'Right',
-            'MAT': 'Maternal',
-            'PAT': 'Paternal',
-            'SUP': 'Supernant',
-            'CELP': 'Cell Pellet',
-            'FFPE': 'FFPE',
-            'CRYO' : 'CRYO',
-            'EDTA' : 'EDTA'
-        }
+        '''
+        Adds display values (label, STATUS html, is_received, parsed dates)
+        to the raw aliquot dicts in sample_data, in place. See
+        aliquots.normalize_aliquots for a compact typed alternative.
+        '''
         for each in sample_data:
-            try:
-                sample_type = type_map[each['U_SAMPLE_TYPE']]
-            except:
-                log.debug('Unable to find sample mapping for {0}'.format(
-                    each['U_SAMPLE_TYPE']
-                ))
-                sample_type = ''
-            try:
-                typ = secondary_type_map[each['U_SECONDARY_SAMPLE_TYPE']]
-                secondary_type = typ
-            except:
-                if each['U_SECONDARY_SAMPLE_TYPE'] != '':
-                    log.debug('Unable to find secondary sample mapping for {0}'.format(
-                        each['U_SECONDARY_SAMPLE_TYPE']
-                    ))
-                secondary_type = ''
-
-            each['label'] = '%s %s' % (sample_type, secondary_type)
-            each['label'] = each['label'].rstrip(' ')
-            if each['STATUS'] == 'U':
-                each['STATUS'] = '<p class="text-warning"><em>Unreceived</em></p>'  # noqa
+            each['label'] = aliquots.sample_label(
+                each['U_SAMPLE_TYPE'], each['U_SECONDARY_SAMPLE_TYPE'])
+            status = each['STATUS']
+            if status == 'U':
+                each['STATUS'] = aliquots.STATUS_UNRECEIVED
                 each['is_received'] = False
-            elif each['STATUS'] == 'X':
-                each['STATUS'] = '<p class="text-danger"><em>Cancelled</em></p>'  # noqa
-            elif each['STATUS'] == 'V' or each['STATUS'] == 'C' or each['STATUS'] == 'P':  # noqa
+            elif status == 'X':
+                each['STATUS'] = aliquots.STATUS_CANCELLED
+            elif status in aliquots.RECEIVED_STATUSES:
                 if each['U_DISPOSED'] == 'T':
-                    each['STATUS'] = '<p class="text-warning"><em>Disposed</em></p>'  # noqa
+                    each['STATUS'] = aliquots.STATUS_DISPOSED
                 else:
-                    each['STATUS'] = '<p class="text-success"><em>Available</em></p>'  # noqa
+                    each['STATUS'] = aliquots.STATUS_AVAILABLE
                 each['is_received'] = True
-                try:
-                    each['U_RECEIVED_DATE_TIME'] = datetime.datetime.strptime(
-                        each['U_RECEIVED_DATE_TIME'], '%d %m %Y %H:%M:%S'
-                    )
-                except:
-                    each['U_RECEIVED_DATE_TIME'] = None
-                try:
-                    each['U_COLLECT_DATE_TIME'] = datetime.datetime.strptime(
-                        each['U_COLLECT_DATE_TIME'], '%d %m %Y %H:%M:%S'
-                    )
-                except:
-                    each['U_COLLECT_DATE_TIME'] = "Unknown"
+                each['U_RECEIVED_DATE_TIME'] = aliquots.parse_datetime(
+                    each['U_RECEIVED_DATE_TIME'])
+                each['U_COLLECT_DATE_TIME'] = aliquots.parse_datetime(
+                    each['U_COLLECT_DATE_TIME']) or "Unknown"
         return sample_data
 
     def configure(self, driver_configuration='', *args, **kwargs):
@@ -291,32 +468,83 @@ class ehbDriver(Driver, RequestHandler):
 
     def subRecordSelectionForm(self, form_url='', record_id='', *args,
                                **kwargs):
-        tpl = open(
-            os.path.join(
-                os.path.dirname(__file__),
-                'templates/sample_display.html'), 'r').read()
+        '''
+        Renders the aliquots of the SDG named record_id. Accepts the page,
+        sorting and filtering arguments of aliquot_page, page_size defaulting
+        to ALIQUOT_PAGE_SIZE.
+        '''
+        options = dict(
+            (key, kwargs[key]) for key in self.ALIQUOT_PAGE_OPTIONS
+            if key in kwargs)
+        options.setdefault('page_size', self.ALIQUOT_PAGE_SIZE)
+        c = self.aliquot_page(record_id, **options)
+        return get_template('sample_display.html').render(c)
+
+    def aliquot_page(self, record_id, page=1, page_size=None, sort_by=None,
+                     descending=False, sample_types=None, statuses=None,
+                     received_after=None, received_before=None):
+        '''
+        Returns one page of the SDG's aliquots rendered as table rows.
+
+        Inputs:
+        page: 1-based page number (clamped to the last page)
+        page_size: aliquots per page, None for all of them
+        sort_by: one of aliquots.SORT_KEYS, None keeps the SDG's order
+        descending: reverses the sort
+        sample_types, statuses, received_after, received_before: filters,
+            see aliquots.filter_aliquots
+
+        page, page_size and descending may be request parameter strings
+        ('2', '25', 'false').
+
+        Outputs:
+        {'rows': html, 'count': number of aliquots in the SDG} plus the page
+        info of aliquots.paginate (total being the number of aliquots
+        matching the filters), or {'error': message, 'rows': ''}
+        '''
+        c = self.get_aliquots(record_id)
+        if 'error' in c:
+            return {'error': c['error'], 'rows': ''}
+        items = c['aliquots']
+        count = len(items)
+        items = aliquots.filter_aliquots(
+            items, sample_types, statuses, received_after, received_before)
+        if sort_by:
+            items = aliquots.sort_aliquots(items, sort_by, descending)
+        items, result = aliquots.paginate(items, page, page_size)
+        result['count'] = count
+        result['rows'] = get_template('aliquot_rows.html').render(
+            aliquots=items)
+        return result
+
+    def load_aliquots(self, record_id):
+        sdg = self.get_sample_data(record_id=record_id)
+        if 'error' in sdg:
+            errorMsg = sdg['error']
+            log.error(errorMsg)
+            return {'error': errorMsg}
+        return {'aliquots': aliquots.normalize_aliquots(sdg)}
 
-        t = Template(tpl)
+    def get_aliquots(self, record_id):
+        '''
+        Returns {'aliquots': [Aliquot]} for the SDG named record_id,
+        or {'error': message} if they could not be retrieved. Aliquot lists
+        are served from the aliquot cache when it is enabled (errors are
+        never cached) and must be treated as read only.
+        '''
+        if self.aliquot_cache is None:
+            return self.load_aliquots(record_id)
+
+        def load():
+            result = self.load_aliquots(record_id)
+            if 'error' in result:
+                raise SampleDataError(result)
+            return result
 
-        # Grab Info about related aliquots here
-        sdg = self.get_sample_data(record_id=record_id)
-        aliquots = self.extract_aliquots(sdg)
         try:
-            aliquots = self.format_aliquots(aliquots)
-        except:
-            raise
-            aliquots = []
-        c = {
-            'aliquots': aliquots,
-        }
-        try: # grab error message
-            errorMsg = (sdg['error'])
-            c = {'error': errorMsg}
-            log.error(errorMsg)
-        except:
-            pass
-        html = t.render(c)
-        return html
+            return self.aliquot_cache.get(record_id, load)
+        except SampleDataError as e:
+            return e.result
 
     def subRecordForm(self, external_record, form_spec='', *args, **kwargs):
         pass
@@ -0,0 +1,73 @@
+'''
+Structured NauREST responses.
+
+A NauREST body is read and decoded once into a NauResult holding the HTTP
+status, the decoded JSON payload and the NauREST error code of
+{"error": code} bodies. NauResult.kind classifies the outcome so callers can
+branch on it (or count it) without touching the body again.
+'''
+import json
+from collections import namedtuple
+
+SUCCESS_STATUSES = (200, 201)
+
+OK = 'ok'
+EMPTY = 'empty'
+NAU_ERROR = 'nau_error'
+UNAUTHORIZED = 'unauthorized'
+NOT_FOUND = 'not_found'
+HTTP_ERROR = 'http_error'
+UNPARSEABLE = 'unparseable'
+
+
+class NauResult(namedtuple('NauResult', ['status', 'payload', 'error_code'])):
+    '''
+    status: the HTTP status
+    payload: the decoded JSON body, None if the status is not a success or
+        the body could not be decoded
+    error_code: the NauREST error code (a string) of a {"error": code}
+        payload, otherwise None
+    NauREST answers with a list, or an {"error": code} dict. Any other
+    payload is unexpected and classified UNPARSEABLE.
+    '''
+    __slots__ = ()
+
+    @property
+    def kind(self):
+        '''
+        One of OK, EMPTY (an empty list), NAU_ERROR, UNAUTHORIZED,
+        NOT_FOUND, HTTP_ERROR (any other unsuccessful status) or UNPARSEABLE
+        '''
+        if self.status == 401:
+            return UNAUTHORIZED
+        if self.status == 404:
+            return NOT_FOUND
+        if self.status not in SUCCESS_STATUSES:
+            return HTTP_ERROR
+        if self.error_code is not None:
+            return NAU_ERROR
+        if not isinstance(self.payload, list):
+            return UNPARSEABLE
+        if not self.payload:
+            return EMPTY
+        return OK
+
+    @property
+    def ok(self):
+        return self.kind == OK
+
+
+def parse(status, body):
+    '''
+    Returns the NauResult of a response with the given status and raw body
+    (bytes or None). The body of an unsuccessful response is ignored.
+    '''
+    payload = error_code = None
+    if status in SUCCESS_STATUSES and body is not None:
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and 'error' in payload:
+            error_code = str(payload['error'])
+    return NauResult(status, payload, error_code)
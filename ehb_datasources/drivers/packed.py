@@ -0,0 +1,125 @@
+'''
+Packed, memory mapped storage of parsed datasource payloads.
+
+Large payloads (REDCap project metadata, full record exports) are written
+once to a packed file and then memory mapped by every worker process that
+needs them, so the OS page cache holds a single shared copy and each item is
+only decoded when it is accessed.
+
+File layout (all integers little endian):
+
+    header   8 byte magic, uint64 item count, uint64 offset of the key index
+    offsets  (count + 1) uint64 offsets of the items in the data section
+    data     the JSON encoded items, back to back
+    keys     optional JSON object {key: [item indexes]}
+'''
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+MAGIC = b'EHBPACK1'
+HEADER = struct.Struct('<8sQQ')
+OFFSET = struct.Struct('<Q')
+
+
+def write_packed(path, items, key=None):
+    '''
+    Atomically writes items (JSON serialisable objects) to a packed file at
+    path. If key (a dict key) is supplied items can be looked up by their
+    value for that key with PackedRecords.find.
+    '''
+    blobs = [json.dumps(item, separators=(',', ':')).encode('utf-8')
+             for item in items]
+    index = {}
+    if key is not None:
+        for i, item in enumerate(items):
+            index.setdefault(str(item.get(key)), []).append(i)
+    data_start = HEADER.size + OFFSET.size * (len(blobs) + 1)
+    offsets = [data_start]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(blobs), offsets[-1]))
+            f.write(b''.join(OFFSET.pack(offset) for offset in offsets))
+            f.write(b''.join(blobs))
+            f.write(json.dumps(index).encode('utf-8'))
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+# pass as max_age to keep packed files forever
+NEVER_EXPIRES = float('inf')
+
+
+def is_fresh(path, max_age):
+    '''
+    True if path exists and was written less than max_age seconds ago (use
+    NEVER_EXPIRES to accept any age)
+    '''
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return False
+    return time.time() - mtime < max_age
+
+
+class PackedRecords(object):
+    '''
+    Read only, lazily decoded sequence of the items in a packed file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._keys_offset = HEADER.unpack_from(
+            self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('Not a packed file: {0}'.format(path))
+        self._index = None
+
+    def _offset(self, i):
+        return OFFSET.unpack_from(self._mmap, HEADER.size + OFFSET.size * i)[0]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start, end = self._offset(i), self._offset(i + 1)
+        return json.loads(self._mmap[start:end].decode('utf-8'))
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def find(self, key):
+        '''
+        Returns the items whose key value (see write_packed) is key
+        '''
+        if self._index is None:
+            self._index = json.loads(
+                self._mmap[self._keys_offset:].decode('utf-8'))
+        return [self[i] for i in self._index.get(str(key), [])]
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,255 @@
+'''
+Client side rate limiting for datasource API credentials.
+
+REDCap administrators throttle API tokens and several processes (batch jobs,
+interactive users) frequently share a single token. A Governor combines a
+token bucket (requests per second with a burst allowance) and a max-in-flight
+semaphore. Governors are shared by every RequestHandler in a process that
+uses the same key, e.g. (host, token) for REDCap.
+
+If a lock_dir is supplied the token bucket state is kept in a small file in
+that directory and updated under an exclusive file lock so that all processes
+on the host draw from the same bucket. The max-in-flight limit is always per
+process.
+'''
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+log = logging.getLogger('ehb_datasources')
+
+
+class InFlightLimitError(Exception):
+    '''
+    Raised when a request cannot get an in flight slot: the calling thread
+    already holds every slot (waiting would deadlock, e.g. it is still
+    reading a streamed response) or none became free within acquire_timeout
+    '''
+
+
+class TokenBucket(object):
+    '''
+    Thread safe token bucket. `rate` tokens are added per second up to
+    `capacity` (the allowed burst).
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, timestamp, now):
+        '''
+        Returns a tuple (tokens, timestamp, wait) where wait is the number of
+        seconds to sleep before a token will be available (0 if one was taken)
+        '''
+        tokens = min(self.capacity, tokens + (now - timestamp) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def try_acquire(self):
+        with self._lock:
+            self.tokens, self.timestamp, wait = self._take(
+                self.tokens, self.timestamp, time.monotonic())
+        return wait
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+class FileTokenBucket(TokenBucket):
+    '''
+    Token bucket whose state is stored in `path` and shared by every process
+    on the host. Falls back to a process local bucket where fcntl is not
+    available.
+    '''
+    STATE = struct.Struct('<dd')
+
+    def __init__(self, path, rate, capacity=None):
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+
+    def try_acquire(self):
+        if fcntl is None:
+            return super(FileTokenBucket, self).try_acquire()
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = os.read(fd, self.STATE.size)
+                now = time.time()
+                if len(raw) == self.STATE.size:
+                    tokens, timestamp = self.STATE.unpack(raw)
+                else:
+                    tokens, timestamp = self.capacity, now
+                tokens, timestamp, wait = self._take(tokens, timestamp, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.STATE.pack(tokens, timestamp))
+            finally:
+                os.close(fd)
+        return wait
+
+
+class Governor(object):
+    '''
+    Gates requests for a single credential.
+
+    Inputs:
+        * rate: requests per second, None for no rate limit
+        * burst: number of requests allowed back to back, defaults to rate
+        * max_in_flight: concurrent requests allowed, None for no limit
+        * max_retries: number of times a request answered with 429 (Too Many
+            Requests) is retried after backing off
+        * bucket_path: if supplied the token bucket is shared across processes
+            through this file
+        * acquire_timeout: seconds to wait for an in flight slot before
+            raising InFlightLimitError, None to wait indefinitely
+
+    A thread that already holds every in flight slot (its earlier responses
+    have not been read to the end or closed) gets InFlightLimitError at once
+    rather than waiting on itself.
+    '''
+
+    def __init__(self, rate=None, burst=None, max_in_flight=None,
+                 max_retries=3, bucket_path=None, acquire_timeout=None):
+        self.bucket = None
+        if rate and bucket_path:
+            self.bucket = FileTokenBucket(bucket_path, rate, burst)
+        elif rate:
+            self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+        if max_in_flight:
+            self.semaphore = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.acquire_timeout = acquire_timeout
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+        # {thread ident: in flight slots held}
+        self._holders = {}
+
+    def acquire(self):
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self.semaphore:
+            self._acquire_slot()
+        if self.bucket:
+            try:
+                self.bucket.acquire()
+            except Exception:
+                self.release()
+                raise
+
+    def _acquire_slot(self):
+        owner = threading.get_ident()
+        if not self.semaphore.acquire(blocking=False):
+            with self._lock:
+                held = self._holders.get(owner, 0)
+            if held >= self.max_in_flight:
+                # a slot may have been freed meanwhile, otherwise waiting
+                # would deadlock
+                if not self.semaphore.acquire(blocking=False):
+                    raise InFlightLimitError(
+                        'This thread holds all {0} in flight slots, read or '
+                        'close its responses before making another '
+                        'request'.format(self.max_in_flight))
+            elif self.acquire_timeout is None:
+                self.semaphore.acquire()
+            elif not self.semaphore.acquire(timeout=self.acquire_timeout):
+                raise InFlightLimitError(
+                    'No in flight slot became free within {0}s'.format(
+                        self.acquire_timeout))
+        with self._lock:
+            self._holders[owner] = self._holders.get(owner, 0) + 1
+
+    def release(self, owner=None):
+        '''
+        Releases an in flight slot held by the thread owner (a thread ident,
+        default the calling thread)
+        '''
+        if self.semaphore:
+            if owner is None:
+                owner = threading.get_ident()
+            with self._lock:
+                held = self._holders.get(owner, 0) - 1
+                if held > 0:
+                    self._holders[owner] = held
+                else:
+                    self._holders.pop(owner, None)
+            self.semaphore.release()
+
+    def backoff(self, seconds):
+        '''
+        Holds back all requests through this governor for `seconds`
+        '''
+        with self._lock:
+            self.blocked_until = max(self.blocked_until,
+                                     time.monotonic() + seconds)
+        log.warning('datasource rate limited, backing off {0}s'.format(
+            seconds))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(key, rate=None, burst=None, max_in_flight=None,
+                 max_retries=3, lock_dir=None, acquire_timeout=None):
+    '''
+    Returns the process wide Governor for `key`, creating it with the supplied
+    settings on first use. Later calls with the same key share the existing
+    governor (and its settings), a warning is logged if they ask for
+    different settings.
+    '''
+    settings = dict(
+        rate=rate, burst=burst, max_in_flight=max_in_flight,
+        max_retries=max_retries, lock_dir=lock_dir,
+        acquire_timeout=acquire_timeout)
+    with _governors_lock:
+        governor = _governors.get(key)
+        if governor is None:
+            bucket_path = None
+            if lock_dir:
+                digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+                bucket_path = os.path.join(
+                    lock_dir, 'ehb-ratelimit-{0}'.format(digest))
+            governor = Governor(rate, burst, max_in_flight, max_retries,
+                                bucket_path, acquire_timeout)
+            governor.settings = settings
+            _governors[key] = governor
+        elif governor.settings != settings:
+            # the key holds the credential, keep it out of the log
+            log.warning(
+                'datasource rate limit already configured with {0}, '
+                'ignoring {1}'.format(
+                    sorted(governor.settings.items()),
+                    sorted(settings.items())))
+        return governor
+
+
+def reset_governors():
+    '''Forget all governors, mostly useful for tests'''
+    with _governors_lock:
+        _governors.clear()
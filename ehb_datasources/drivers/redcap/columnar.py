@@ -0,0 +1,217 @@
+'''
+Parsing of REDCap CSV exports.
+
+Exports are streamed from the response through csv.reader, either into
+records or straight into one list per column rather than a dict per
+record. Values are converted to Python types according to each field's
+text_validation_type_or_show_slider_number in the project metadata. pandas
+and pyarrow are optional, they are only imported when a DataFrame or Arrow
+table is requested.
+'''
+import codecs
+import csv
+import datetime
+import io
+import re
+from collections import OrderedDict
+
+OUTPUT_RECORDS = 'records'
+OUTPUT_COLUMNS = 'columns'
+OUTPUT_PANDAS = 'pandas'
+OUTPUT_ARROW = 'arrow'
+
+LINE_END = re.compile('\r\n|\r|\n')
+
+
+def to_int(value):
+    return int(value)
+
+
+def to_float(value):
+    # number_comma_decimal fields use a comma as the decimal separator
+    return float(value.replace(',', '.'))
+
+
+def to_date(value):
+    # REDCap always exports dates as YYYY-MM-DD whatever the validation type
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def to_datetime(value):
+    # YYYY-MM-DD HH:MM or YYYY-MM-DD HH:MM:SS
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]),
+        int(value[17:19]) if len(value) > 16 else 0)
+
+
+def converter_for(validation_type):
+    '''
+    Returns the conversion function for a REDCap text validation type or None
+    if values of this type should be left as strings
+    '''
+    if not validation_type:
+        return None
+    if validation_type == 'integer':
+        return to_int
+    if validation_type.startswith('number'):
+        return to_float
+    if validation_type.startswith('date_'):
+        return to_date
+    if validation_type.startswith('datetime_'):
+        return to_datetime
+    return None
+
+
+def converters_from_metadata(metadata):
+    '''
+    Returns {field_name: conversion function} for the typed fields in the
+    (JSON) project metadata
+    '''
+    converters = {}
+    for field in metadata or []:
+        converter = converter_for(
+            field.get('text_validation_type_or_show_slider_number'))
+        if converter:
+            converters[field['field_name']] = converter
+    return converters
+
+
+def convert_value(value, converter):
+    '''
+    Applies converter to a non empty value, empty values become None. Values
+    that do not parse are left untouched.
+    '''
+    if value == '':
+        return None
+    try:
+        return converter(value)
+    except (ValueError, IndexError):
+        return value
+
+
+def convert_column(values, converter):
+    return [convert_value(value, converter) for value in values]
+
+
+def iter_lines(response, encoding='utf-8', chunk_size=64 * 1024):
+    '''
+    Yields the lines (newlines included, as csv.reader expects) of a response
+    body read chunk_size bytes at a time. Only \r\n, \r and \n end a line,
+    the other separators str.splitlines knows (\u2028, \x85, ...) are
+    ordinary characters in REDCap values.
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)('backslashreplace')
+    pending = ''
+    while True:
+        chunk = response.read(chunk_size)
+        pending += decoder.decode(chunk or b'', final=not chunk)
+        start = 0
+        for match in LINE_END.finditer(pending):
+            end = match.end()
+            if chunk and end == len(pending) and match.group() == '\r':
+                # a \r that may be followed by \n
+                break
+            yield pending[start:end]
+            start = end
+        pending = pending[start:]
+        if not chunk:
+            if pending:
+                yield pending
+            return
+
+
+def iter_rows(response, encoding='utf-8'):
+    '''
+    Yields the rows (lists of strings) of a streamed CSV export
+    '''
+    return csv.reader(iter_lines(response, encoding))
+
+
+def fit_row(row, width):
+    '''
+    Pads a short (truncated) row with empty values and cuts a long one to
+    width values
+    '''
+    if len(row) == width:
+        return row
+    return (row + [''] * width)[:width]
+
+
+def records_from_rows(rows, converters=None):
+    '''
+    Yields a dict per record from an iterable of CSV rows whose first row is
+    the header, converting typed fields (empty values become None). Short and
+    long rows are fitted to the header (see fit_row), blank lines skipped.
+    '''
+    rows = iter(rows)
+    try:
+        header = next(rows)
+    except StopIteration:
+        return
+    converters = [
+        (name, converter) for name, converter in (converters or {}).items()
+        if name in header
+    ]
+    width = len(header)
+    for row in rows:
+        if not row:
+            continue
+        record = dict(zip(header, fit_row(row, width)))
+        for name, converter in converters:
+            record[name] = convert_value(record[name], converter)
+        yield record
+
+
+def columns_from_rows(rows, converters=None):
+    '''
+    Builds an OrderedDict {column name: [values]} from an iterable of CSV rows
+    (lists of strings) whose first row is the header. Short and long rows are
+    fitted to the header (see fit_row), blank lines skipped.
+    '''
+    rows = iter(rows)
+    try:
+        header = next(rows)
+    except StopIteration:
+        return OrderedDict()
+    values = [[] for name in header]
+    appends = [column.append for column in values]
+    width = len(appends)
+    for row in rows:
+        if len(row) != width:
+            # blank trailing lines
+            if not row:
+                continue
+            row = fit_row(row, width)
+        for append, value in zip(appends, row):
+            append(value)
+    columns = OrderedDict()
+    converters = converters or {}
+    for name, column in zip(header, values):
+        converter = converters.get(name)
+        if converter:
+            column = convert_column(column, converter)
+        columns[name] = column
+    return columns
+
+
+def columns_from_csv(text, converters=None):
+    '''
+    Parses a CSV export (str) into columns, see columns_from_rows
+    '''
+    return columns_from_rows(
+        csv.reader(io.StringIO(text, newline='')), converters)
+
+
+def to_output(columns, output=OUTPUT_COLUMNS):
+    '''
+    Converts columns to the requested output: the columns themselves, a
+    pandas DataFrame or a pyarrow Table.
+    '''
+    if output == OUTPUT_PANDAS:
+        import pandas
+        return pandas.DataFrame(columns, columns=list(columns.keys()))
+    if output == OUTPUT_ARROW:
+        import pyarrow
+        return pyarrow.table(columns)
+    return columns
@@ -1,22 +1,31 @@
+import copy
+import datetime
+import hashlib
 import json
+import logging
 import os
 import re
-import urllib.request
+import threading
+import time
 import urllib.parse
-import urllib.error
-import xml.dom.minidom as xml
 from xml.parsers.expat import ExpatError
-from collections import OrderedDict
-from jinja2 import Template
+from collections import OrderedDict, namedtuple
 
 from ehb_datasources.drivers.exceptions import PageNotFound,\
     ImproperArguments, ServerError
 from ehb_datasources.drivers.Base import Driver, RequestHandler
 from ehb_datasources.drivers.exceptions import RecordDoesNotExist,\
     RecordCreationError
-from ehb_datasources.drivers.redcap.formBuilderJson import FormBuilderJson
+from ehb_datasources.drivers.redcap import columnar
+from ehb_datasources.drivers.redcap.snapshot import format_timestamp
+from ehb_datasources.drivers import singleflight
+from ehb_datasources.drivers.packed import PackedRecords, write_packed, \
+    is_fresh
+from ehb_datasources.drivers.cache import TTLCache
 from functools import reduce
 
+log = logging.getLogger(__file__)
+
 
 class GenericDriver(RequestHandler):
     '''
@@ -29,12 +38,30 @@ class GenericDriver(RequestHandler):
 
     Supports imports, exports, and exporting metadata. Currently files are
     not handled.
+
+    Identical concurrent exports (same host, token and parameters) made from
+    any thread in the process share a single HTTP request unless
+    single_flight is set to False.
+
+    If cache_dir is set, packed_metadata and packed_export persist parsed
+    payloads there as memory mapped packed files (see drivers.packed) that are
+    shared by every process using the same directory. Packed files are
+    rebuilt once older than cache_max_age seconds (default CACHE_MAX_AGE,
+    packed.NEVER_EXPIRES keeps them forever).
     '''
+    CACHE_MAX_AGE = 60 * 60
 
-    def __init__(self, host, path, token, secure=False):
+    def __init__(self, host, path, token, secure=False, cache_dir=None,
+                 cache_max_age=None):
         super(GenericDriver, self).__init__(host, secure)
         self.token = token
         self.path = path
+        self.cache_dir = cache_dir
+        if cache_max_age is None:
+            cache_max_age = self.CACHE_MAX_AGE
+        self.cache_max_age = cache_max_age
+        self._packed_files = {}
+        self._packed_lock = threading.Lock()
 
     FORMAT_JSON = 'json'
     FORMAT_XML = 'xml'
@@ -61,12 +88,98 @@ class GenericDriver(RequestHandler):
     CONTENT_METADATA = 'metadata'
     STANDARD_HEADER = {'Content-Type': 'application/x-www-form-urlencoded'}
 
+    single_flight = True
+
+    def throttle_key(self):
+        # REDCap throttles per token, so share limits across (host, token)
+        return (self.host, self.token)
+
     def build_parameter(self, _list):
         p = ''
         for item in _list:
             p += str(item) + ','
         return p[0: p.__len__() - 1]
 
+    def export(self, headers, body):
+        '''
+        POSTs an export request and returns the processed response body.
+        Concurrent identical exports are coalesced into one request.
+        '''
+        def fetch():
+            return self.processResponse(
+                self.POST(self.path, headers, body),
+                self.path
+            )
+        if not self.single_flight:
+            return fetch()
+        key = (
+            self.host,
+            self.path,
+            self.token,
+            body,
+            tuple(sorted((headers or {}).items()))
+        )
+        return singleflight.requests.do(key, fetch)
+
+    def packed(self, name, load, key=None, max_age=None):
+        '''
+        Returns the PackedRecords stored under name in cache_dir, calling
+        load() and writing its result first if there is no packed file for
+        this project younger than max_age (default cache_max_age) seconds.
+        The PackedRecords previously returned for name are not closed when
+        the file is rebuilt, other threads may still be reading them: their
+        mapping is released with the last reference to them.
+        '''
+        digest = hashlib.sha1(
+            '{0}{1}:{2}'.format(self.host, self.path, self.token)
+            .encode('utf-8')).hexdigest()
+        path = os.path.join(
+            self.cache_dir, '{0}-{1}.pack'.format(digest, name))
+        if max_age is None:
+            max_age = self.cache_max_age
+        if not is_fresh(path, max_age):
+            write_packed(path, load(), key)
+        mtime = os.path.getmtime(path)
+        with self._packed_lock:
+            cached = self._packed_files.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            packed = PackedRecords(path)
+            self._packed_files[path] = (mtime, packed)
+        return packed
+
+    def packed_metadata(self, max_age=None):
+        '''
+        Returns the project metadata as PackedRecords (one item per field,
+        findable by form_name)
+        '''
+        return self.packed(
+            'metadata', self.read_metadata, 'form_name', max_age)
+
+    def packed_export(self, name, key=None, max_age=None, **kwargs):
+        '''
+        Returns a JSON record export (see read_records for the allowed kwargs)
+        as PackedRecords stored under name, optionally findable by the value
+        of the key field (e.g. the record id field).
+        '''
+        return self.packed(
+            name, lambda: self.read_records(**kwargs), key, max_age)
+
+    def records_xml(self, rows):
+        '''
+        Returns the XML import document for rows, each an iterable of
+        (field name, value) pairs
+        '''
+        xml = '<records>'
+        for row in rows:
+            xml += '<item>'
+            for k, v in row:
+                # ]]> cannot appear inside a CDATA section
+                v = str(v).replace(']]>', ']]]]><![CDATA[>')
+                xml += '<' + k + '><![CDATA[' + v + ']]></' + k + '>'
+            xml += '</item>'
+        return xml + '</records>'
+
     def write_records(self, data, _type=TYPE_FLAT,
                       overwrite=OVERWRITE_NORMAL, headers=STANDARD_HEADER,
                       useRawData=False):
@@ -107,7 +220,7 @@ class GenericDriver(RequestHandler):
         else:
             req_data = data.toxml('UTF-8')
 
-        headers['Accept'] = 'text/xml'
+        headers = dict(headers, Accept='text/xml')
         params = {
             'token': self.token,
             'content': self.CONTENT_RECORD,
@@ -124,8 +237,9 @@ class GenericDriver(RequestHandler):
             num_recs_updated = -1
             # This is necessary because the REDCap API changed it's response
             # format for record import at REDCap version 4.8
+            from xml.dom import minidom
             try:
-                response_xml = xml.parseString(processed_response)
+                response_xml = minidom.parseString(processed_response)
                 num_recs_updated = int(
                     response_xml.getElementsByTagName(
                         'count'
@@ -142,6 +256,32 @@ class GenericDriver(RequestHandler):
             # exception
             return self.processResponse(response, self.path)
 
+    def record_export_body(self, _format, _type, **kwargs):
+        '''
+        Returns the urlencoded body of a record export request, see
+        read_records for the allowed kwargs
+        '''
+        params = {
+            'token': self.token,
+            'content': self.CONTENT_RECORD,
+            'format': _format,
+            'type': _type
+        }
+        params = OrderedDict(sorted(params.items(), key=lambda t: t[0]))
+
+        for item in ['records', 'fields', 'forms', 'events']:
+            if kwargs.get(item):
+                params[item] = self.build_parameter(kwargs.get(item))
+
+        if kwargs.get('event'):
+            params['event'] = kwargs.get('event')
+
+        for item in ['dateRangeBegin', 'dateRangeEnd']:
+            if kwargs.get(item):
+                params[item] = format_timestamp(kwargs.get(item))
+
+        return urllib.parse.urlencode(params)
+
     def read_records(self, _format=FORMAT_JSON, _type=TYPE_FLAT,
                      headers=STANDARD_HEADER, rawResponse=False, **kwargs):
         '''
@@ -163,6 +303,7 @@ class GenericDriver(RequestHandler):
                 if _format==FORMAT_JSON : Python json object
                 if _format==FORMAT_XML : Python xml.dom.minidom
                 if _format==FORMAT_CSV : Unprocessed String
+                (use read_csv to stream and parse CSV exports)
 
         Allowed Kwargs:
         ---------------
@@ -178,31 +319,83 @@ class GenericDriver(RequestHandler):
             for (longitudinal only) default is all.
         * event: a String value indicating whether the Event Label or
             Unique Event Name should be exported default is label
+        * dateRangeBegin: only export records created or modified after this
+            time (datetime or 'YYYY-MM-DD HH:MM:SS' in REDCap server time)
+        * dateRangeEnd: only export records created or modified before this
+            time
 
         '''
-        params = {
-            'token': self.token,
-            'content': self.CONTENT_RECORD,
-            'format': _format,
-            'type': _type
-        }
-        params = OrderedDict(sorted(params.items(), key=lambda t: t[0]))
+        body = self.record_export_body(_format, _type, **kwargs)
+        if rawResponse:
+            return self.POST(self.path, headers, body)
+        else:
+            return self.transformResponse(_format, self.export(headers, body))
 
-        for item in ['records', 'fields', 'forms', 'events']:
-            if kwargs.get(item):
-                params[item] = self.build_parameter(kwargs.get(item))
+    def iter_csv(self, headers=STANDARD_HEADER, **kwargs):
+        '''
+        Requests a flat CSV export and yields its rows (lists of strings,
+        header first) as the response is received. Allowed kwargs are as for
+        read_records.
+        '''
+        response = self.POST(
+            self.path,
+            headers,
+            self.record_export_body(self.FORMAT_CSV, self.TYPE_FLAT, **kwargs)
+        )
+        if response.status not in (200, 201):
+            # let processResponse raise the appropriate exception
+            self.processResponse(response, self.path)
+        try:
+            for row in columnar.iter_rows(response):
+                yield row
+        finally:
+            response.close()
 
-        if kwargs.get('event'):
-            params['event'] = kwargs.get('event')
+    def read_csv(self, output=columnar.OUTPUT_RECORDS, typed=True,
+                 headers=STANDARD_HEADER, **kwargs):
+        '''
+        Exports records as CSV, which is smaller on the wire than JSON, and
+        parses the response as it streams in.
 
-        response = self.POST(self.path, headers, urllib.parse.urlencode(params))
-        if rawResponse:
-            return response
-        else:
-            return self.transformResponse(
-                _format,
-                self.processResponse(response, self.path)
-            )
+        Inputs:
+        -------
+
+        * output : one of
+            columnar.OUTPUT_RECORDS (default) list of record dicts, like
+                read_records
+            columnar.OUTPUT_COLUMNS OrderedDict of {field_name: [values]},
+                which avoids allocating a dict per record on large exports
+            columnar.OUTPUT_PANDAS a pandas DataFrame
+            columnar.OUTPUT_ARROW a pyarrow Table
+          pandas and pyarrow are only required for those outputs.
+        * typed : boolean.
+
+            If True (default) the project metadata is read and integer,
+            number, date and datetime validated fields are converted to int,
+            float, datetime.date and datetime.datetime (empty values become
+            None). Otherwise all values are strings.
+
+        * headers : headers dictionary sent in request
+
+        Allowed Kwargs: as read_records
+        '''
+        converters = None
+        if typed:
+            converters = columnar.converters_from_metadata(
+                self.read_metadata(fields=kwargs.get('fields')))
+        rows = self.iter_csv(headers, **kwargs)
+        if output == columnar.OUTPUT_RECORDS:
+            return list(columnar.records_from_rows(rows, converters))
+        columns = columnar.columns_from_rows(rows, converters)
+        return columnar.to_output(columns, output)
+
+    def read_columns(self, output=columnar.OUTPUT_COLUMNS, typed=True,
+                     headers=STANDARD_HEADER, **kwargs):
+        '''
+        Exports records as columns instead of a list of record dicts, see
+        read_csv
+        '''
+        return self.read_csv(output, typed, headers, **kwargs)
 
     def read_metadata(self, _format=FORMAT_JSON, headers=STANDARD_HEADER,
                       rawResponse=False, **kwargs):
@@ -249,10 +442,7 @@ class GenericDriver(RequestHandler):
                 params[item] = self.build_parameter(kwargs.get(item))
 
         params = urllib.parse.urlencode(params).replace('forms', 'forms[]')
-        response = self.processResponse(
-            self.POST(self.path, headers, params),
-            self.path
-        )
+        response = self.export(headers, params)
         if rawResponse:
             return response
         else:
@@ -312,9 +502,67 @@ class GenericDriver(RequestHandler):
             raise Exception(msg)
 
 
+# the precomputed form structures published by ehbDriver.warm_up
+WarmUp = namedtuple('WarmUp', [
+    'metadata',
+    'form_fields',
+    'form_field_info',
+    'branching_references',
+    'loaded_at',
+])
+
+
 class ehbDriver(Driver, GenericDriver):
+    '''
+    REDCap driver for the eHB.
+
+    If record_cache_ttl (seconds) is supplied, single record JSON exports made
+    through get (and the record exports made by subRecordForm) are cached for
+    that long in an LRU cache of at most record_cache_size entries. Entries
+    for a record are dropped whenever this driver writes that record.
+
+    If missing_record_ttl (seconds) is supplied, single record exports that
+    find no record are remembered for that long (at most
+    missing_record_cache_size of them) and repeated requests raise
+    RecordDoesNotExist without contacting REDCap until the record is created
+    through this driver.
+
+    If a snapshot (see redcap.snapshot) is assigned to the snapshot
+    attribute, get(..., local=True) is answered from the snapshot without
+    contacting REDCap.
+
+    cache_dir and cache_max_age are passed to GenericDriver, when set the
+    metadata used to build forms is read from the packed metadata file.
+
+    The form structures computed by warm_up are recomputed from fresh
+    metadata once older than metadata_ttl seconds (default cache_max_age),
+    calling warm_up again refreshes them immediately.
+
+    If prefetch_next_form is set (and the record cache is enabled), saving a
+    form with processForm starts a background thread that loads the record
+    data of the next form of the same event into the record cache, so the
+    next form renders without waiting on REDCap. Only a warmed up driver
+    (see warm_up) prefetches.
+
+    Once configured, an instance holds no per request state and can be shared
+    by every thread serving the project: forms are built by a new
+    FormBuilderJson per call and request state is kept per thread (see
+    RequestHandler).
+    '''
 
-    def __init__(self, url, password, username=None, secure=False):
+    COMPLETION_CHUNK_SIZE = 250
+    BATCH_CHUNK_SIZE = 250
+    COMPLETE_CODES_KEY = '_complete_codes'
+    SYNC_OVERLAP = datetime.timedelta(minutes=5)
+    # field types whose values FormBuilderJson submits (checkboxes aside)
+    FORM_FIELD_TYPES = ('text', 'notes', 'dropdown', 'radio', 'yesno',
+                        'truefalse')
+
+    def __init__(self, url, password, username=None, secure=False,
+                 record_cache_ttl=None, record_cache_size=128,
+                 cache_dir=None, cache_max_age=None, missing_record_ttl=None,
+                 missing_record_cache_size=1024, prefetch_next_form=False,
+                 metadata_ttl=None):
         def getHost(url):
             return url.split('/')[2]
 
@@ -339,7 +587,9 @@ class ehbDriver(Driver, GenericDriver):
             host=host,
             path=path,
             token=password,
-            secure=secure
+            secure=secure,
+            cache_dir=cache_dir,
+            cache_max_age=cache_max_age
         )
         self.unique_event_names = None
         self.event_labels = None
@@ -347,6 +597,74 @@ class ehbDriver(Driver, GenericDriver):
         self.form_data_ordered = None
         self.form_names = None
         self.record_id_field_name = None
+        self._record_id_field = None
+        self.metadata_ttl = metadata_ttl
+        self._warm = None
+        self._warming = singleflight.SingleFlight()
+        self.snapshot = None
+        self.record_cache = None
+        if record_cache_ttl:
+            self.record_cache = TTLCache(record_cache_ttl, record_cache_size)
+        self.missing_records = None
+        if missing_record_ttl:
+            self.missing_records = TTLCache(
+                missing_record_ttl, missing_record_cache_size)
+        self.prefetch_next_form = prefetch_next_form
+        self._prefetching = set()
+        self._prefetch_lock = threading.Lock()
+
+    @property
+    def metadata(self):
+        warm = self._warm
+        return warm.metadata if warm else None
+
+    @property
+    def form_fields(self):
+        warm = self._warm
+        return warm.form_fields if warm else None
+
+    @property
+    def form_field_info(self):
+        warm = self._warm
+        return warm.form_field_info if warm else None
+
+    @property
+    def branching_references(self):
+        warm = self._warm
+        return warm.branching_references if warm else None
+
+    def record_cache_key(self, record_id, kwargs):
+        '''
+        Returns the record and missing record cache key of a single record
+        export, or None if its arguments cannot be hashed (the caches are
+        then bypassed). Lists become tuples, sets sorted tuples and dicts
+        sorted tuples of their items.
+        '''
+        def freeze(v):
+            if isinstance(v, (list, tuple)):
+                return tuple(freeze(i) for i in v)
+            if isinstance(v, (set, frozenset)):
+                return tuple(sorted(freeze(i) for i in v))
+            if isinstance(v, dict):
+                return tuple(sorted((k, freeze(i)) for k, i in v.items()))
+            return v
+        try:
+            key = (record_id,) + tuple(
+                sorted((k, freeze(v)) for k, v in kwargs.items()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def invalidate_record(self, record_id):
+        '''
+        Drops any cached exports of record_id, and any cached miss
+        '''
+        if self.record_cache is not None:
+            self.record_cache.invalidate_where(lambda key: key[0] == record_id)
+        if self.missing_records is not None:
+            self.missing_records.invalidate_where(
+                lambda key: key[0] == record_id)
 
     def meta(self, *args, **kwargs):
         '''returns meta data'''
@@ -382,7 +700,25 @@ class ehbDriver(Driver, GenericDriver):
         If ONLY record_id is specified (indicating a single record is desired)
         and NO record is found, a RecordDoesNotExist exception will be raised.
 
+        Single record JSON exports are served from the record cache when it is
+        enabled, callers receive their own copy of the cached value. Single
+        record exports that found no record are not repeated while the miss
+        is cached (see missing_record_ttl).
+
+        If local=True the rows are read from the driver's snapshot (only
+        record_id, records, fields and events are supported), an Exception
+        is raised if no snapshot is assigned.
+
         '''
+        if kwargs.pop('local', False):
+            if self.snapshot is None:
+                raise Exception(
+                    'get(local=True) requires a snapshot, assign one to the '
+                    'driver\'s snapshot attribute')
+            rows = self.snapshot.get(record_id, *args, **kwargs)
+            if record_id and not kwargs.get('records') and not rows:
+                raise RecordDoesNotExist(self.url, self.path, record_id)
+            return rows
 
         # record_id = kwargs.pop('record_id',None)
         records = kwargs.pop('records', [])
@@ -391,6 +727,26 @@ class ehbDriver(Driver, GenericDriver):
         if record_id and record_id not in records:
             records.append(record_id)
         if len(records) == 1:
+            cache_key = None
+            if (
+                self.record_cache is not None and
+                not rawResponse and
+                _format == self.FORMAT_JSON
+            ):
+                cache_key = self.record_cache_key(records[0], kwargs)
+            if cache_key is not None:
+                cached = self.record_cache.get(cache_key)
+                if cached is not None:
+                    return copy.deepcopy(cached)
+                # a write made while exporting makes the export stale
+                cache_version = self.record_cache.version()
+            missing_key = None
+            if self.missing_records is not None:
+                missing_key = self.record_cache_key(records[0], kwargs)
+            if missing_key is not None:
+                if self.missing_records.get(missing_key):
+                    raise RecordDoesNotExist(self.url, self.path, record_id)
+                missing_version = self.missing_records.version()
             try:
                 rv = self.read_records(
                     records=records,
@@ -418,10 +774,22 @@ class ehbDriver(Driver, GenericDriver):
                             self.path,
                             record_id)
                     else:
+                        if cache_key:
+                            self.record_cache.set(
+                                cache_key, rv, cache_version)
+                            return copy.deepcopy(rv)
                         return rv
                 else:
                     raise RecordDoesNotExist(self.url, self.path, record_id)
+            except RecordDoesNotExist:
+                if missing_key:
+                    self.missing_records.set(
+                        missing_key, True, missing_version)
+                raise
             except PageNotFound:
+                if missing_key:
+                    self.missing_records.set(
+                        missing_key, True, missing_version)
                 raise RecordDoesNotExist(self.url, self.path, record_id)
         elif len(records) > 0:
             return self.read_records(records=records, **kwargs)
@@ -503,26 +871,18 @@ class ehbDriver(Driver, GenericDriver):
         else:
             raise Exception('Unable to obtain meta_data')
 
-        if event:
-            record = '<records><item><' + id_label + '><![CDATA[' + study_id +\
-                ']]></' + id_label + '><redcap_event_name><![CDATA[' + event +\
-                ']]></redcap_event_name>'
-        else:
-            record = '<records><item><' + id_label + '><![CDATA[' + study_id +\
-                ']]></' + id_label + '>'
+        record = self.records_xml(
+            [self.new_record_row(id_label, study_id, event, record_values)])
 
-        if record_values:
-            for k, v in record_values:
-                record += '<' + k + '><![CDATA[' + v + ']]></' + k + '>'
-
-        record += '</item></records>'
-
-        if 1 != self.write_records(
-            data=xml.parseString(record),
+        from xml.dom import minidom
+        written = self.write_records(
+            data=minidom.parseString(record),
             overwrite=overwrite
-        ):
+        )
+        self.invalidate_record(study_id)
+        if 1 != written:
             errors = self.write_records(
-                data=xml.parseString(record),
+                data=minidom.parseString(record),
                 overwrite=overwrite)
             raise RecordCreationError(self.url, self.path, study_id, errors)
         else:
@@ -531,6 +891,179 @@ class ehbDriver(Driver, GenericDriver):
     def update(self, *args, **kwargs):
         return 0
 
+    def new_record_row(self, id_label, study_id, event=None,
+                       record_values=None):
+        '''
+        Returns the import row (a list of (field, value) pairs) creating
+        study_id
+        '''
+        row = [(id_label, study_id)]
+        if event:
+            row.append(('redcap_event_name', event))
+        if record_values:
+            row.extend(record_values)
+        return row
+
+    def get_many(self, record_ids, *args, **kwargs):
+        '''
+        Retrieves several records with one JSON export per chunk_size
+        (default BATCH_CHUNK_SIZE) records.
+
+        Optional Inputs
+        ---------------
+
+        * chunk_size
+        * records : further record ids, merged after record_ids (as get)
+        * fields, forms, events, ... : as read_records
+
+        Returns an OrderedDict {record_id: [rows]} in the order of record_ids,
+        records that do not exist map to None.
+        '''
+        chunk_size = kwargs.pop('chunk_size', None) or self.BATCH_CHUNK_SIZE
+        record_ids = list(OrderedDict.fromkeys(
+            list(record_ids) + list(kwargs.pop('records', None) or [])))
+        id_field = self.get_record_id_field()
+        fields = kwargs.get('fields')
+        if fields and id_field not in fields:
+            kwargs['fields'] = [id_field] + list(fields)
+        found = {}
+        for i in range(0, len(record_ids), chunk_size):
+            rows = self.read_records(
+                records=record_ids[i: i + chunk_size], **kwargs)
+            for row in rows or []:
+                found.setdefault(row.get(id_field), []).append(row)
+        return OrderedDict(
+            (record_id, found.get(record_id)) for record_id in record_ids)
+
+    def create_many(self, record_id_prefix, record_id_validator, items,
+                    *args, **kwargs):
+        '''
+        Creates several records with one import per chunk_size (default
+        BATCH_CHUNK_SIZE) records. Random ids generated for items without a
+        record_id are checked against REDCap in a single export per attempt.
+
+        Inputs:
+        -------
+
+        * record_id_prefix, record_id_validator : as create
+        * items : list of dicts of per record create arguments (record_id,
+            redcap_event_name, record_values)
+
+        Optional Inputs (kwargs):
+        -------------------------
+
+        * overwrite : as create
+        * chunk_size
+        * any create argument, used for items that do not set it
+
+        Returns the list of created record ids in the order of items. Raises
+        RecordCreationError if REDCap reports fewer records written than sent
+        in a chunk.
+        '''
+        chunk_size = kwargs.pop('chunk_size', None) or self.BATCH_CHUNK_SIZE
+        overwrite = kwargs.pop('overwrite', self.OVERWRITE_NORMAL)
+        items = [dict(kwargs, **item) for item in items]
+        if not items:
+            return []
+
+        def prefixed(pid):
+            if record_id_prefix:
+                return record_id_prefix + ':' + pid
+            return pid
+
+        study_ids = [
+            prefixed(item['record_id']) if item.get('record_id') else None
+            for item in items
+        ]
+        attempts = 0
+        while None in study_ids:
+            if attempts == 10:
+                raise RecordCreationError(
+                    self.url, self.path, '',
+                    'Unable to generate unused record ids')
+            attempts += 1
+            candidates = dict(
+                (i, prefixed(self.create_random_record_id()))
+                for i, study_id in enumerate(study_ids) if study_id is None)
+            existing = self.get_many(
+                list(candidates.values()),
+                fields=[self.get_record_id_field()])
+            for i, study_id in candidates.items():
+                if existing.get(study_id) is None:
+                    study_ids[i] = study_id
+
+        id_label = self.get_record_id_field()
+        rows = []
+        for study_id, item in zip(study_ids, items):
+            event = None
+            if self.unique_event_names:
+                event = item.get(
+                    'redcap_event_name', self.unique_event_names[0])
+            rows.append(self.new_record_row(
+                id_label, study_id, event, item.get('record_values')))
+
+        from xml.dom import minidom
+        for i in range(0, len(rows), chunk_size):
+            chunk_ids = study_ids[i: i + chunk_size]
+            written = self.write_records(
+                data=minidom.parseString(
+                    self.records_xml(rows[i: i + chunk_size])),
+                overwrite=overwrite
+            )
+            for study_id in chunk_ids:
+                self.invalidate_record(study_id)
+            if written != len(chunk_ids):
+                raise RecordCreationError(
+                    self.url, self.path, ','.join(chunk_ids), written)
+        return study_ids
+
+    def update_many(self, items, *args, **kwargs):
+        '''
+        Writes field values for several records with one import per
+        chunk_size (default BATCH_CHUNK_SIZE) records.
+
+        Inputs:
+        -------
+
+        * items : list of dicts of field values, each including the record id
+            field (and redcap_event_name for longitudinal projects)
+
+        Optional Inputs (kwargs):
+        -------------------------
+
+        * overwrite : OVERWRITE_NORMAL (default) or OVERWRITE_OVERWRITE
+        * chunk_size
+
+        Returns a list with one result per item, in the order of items:
+        {'record_id': the item's record id, 'error': None if the item was
+        written, otherwise the repr of the error}. REDCap rejects an import
+        as a whole, so if a chunk fails every item in it gets the chunk's
+        error and the remaining chunks are still written.
+        '''
+        chunk_size = kwargs.pop('chunk_size', None) or self.BATCH_CHUNK_SIZE
+        overwrite = kwargs.pop('overwrite', self.OVERWRITE_NORMAL)
+        id_field = self.get_record_id_field()
+        from xml.dom import minidom
+        results = []
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i: i + chunk_size]
+            error = None
+            try:
+                self.write_records(
+                    data=minidom.parseString(self.records_xml(
+                        [list(item.items()) for item in chunk])),
+                    overwrite=overwrite
+                )
+            except Exception as e:
+                error = repr(e)
+            finally:
+                for item in chunk:
+                    self.invalidate_record(item.get(id_field))
+            results.extend(
+                {'record_id': item.get(id_field), 'error': error}
+                for item in chunk)
+        return results
+
     def configure(self, driver_configuration='', *args, **kwargs):
         '''
         Configures the driver for the specific REDCap project.
@@ -571,41 +1104,285 @@ class ehbDriver(Driver, GenericDriver):
         * form_event_data : dictionary of the form {"form_label":[Booleans]
           where the number of Booleans
           should be the same as the number of events and the value indicates if
-          this form should be available for that event'''
+          this form should be available for that event
+
+        Optional Inputs (kwargs or configuration):
+        ------------------------------------------
+
+        * warm_up : if true, warm_up is called once the driver is configured
+        '''
 
         config = driver_configuration
 
         if config:
-            json_config = json.loads(config)
+            # OrderedDict preserves the order of the form_data keys
+            json_config = json.loads(config, object_pairs_hook=OrderedDict)
             self.record_id_field_name = json_config.get('record_id_field_name',
                                                         None)
             self.form_names = json_config.get('form_names', None)
             if self.form_names:
                 self.form_data_ordered = self.form_names
             else:
-                # longitudinal study
-                self.form_data_ordered = []
-                self.unique_event_names = json_config['unique_event_names']
-                self.event_labels = json_config['event_labels']
-                self.form_data = {}
+                # longitudinal study, the form data is built before it is
+                # assigned so threads sharing this driver never see it half
+                # populated
+                form_data_ordered = []
+                form_data = {}
                 for k in list(json_config['form_data'].keys()):
                     bools = []
                     values = json_config['form_data'][k]
                     for v in values:
                         bools.append(v == 1)
-                    self.form_data[k] = bools
-                temp = config[config.index('form_data') + 12: len(config)]
-                temp = temp[0: temp.index('}')]
-                for item in re.findall(r'"[^"\r\n]*"', temp):
-                    self.form_data_ordered.append(item[1: len(item) - 1])
+                    form_data[k] = bools
+                    form_data_ordered.append(k)
+                self.unique_event_names = json_config['unique_event_names']
+                self.event_labels = json_config['event_labels']
+                self.form_data = form_data
+                self.form_data_ordered = form_data_ordered
+            warm_up = kwargs.pop('warm_up', json_config.get('warm_up', False))
         else:
             self.unique_event_names = kwargs.pop('unique_event_names', None)
             self.event_labels = kwargs.pop('event_labels', None)
             self.form_event_data = kwargs.pop('form_event_data', None)
             self.form_names = kwargs.pop('form_names', None)
+            warm_up = kwargs.pop('warm_up', False)
+
+        if warm_up:
+            self.warm_up()
+
+    def warm_up(self):
+        '''
+        Fetches the project metadata and precomputes everything about the
+        configured forms that does not depend on record values, so the first
+        form rendered or saved after configure does not pay for it. The
+        results are published together as a WarmUp (also exposed as the
+        attributes below) and returned:
+
+        * metadata : the project metadata (JSON)
+        * form_fields : {form_name: [field metadata]}
+        * form_field_info : {form_name: {field_name: {'type': field_type}}}
+            the field information processForm needs to build an import (the
+            same structure FormBuilderJson caches in the session)
+        * branching_references : {form_name: set of (unique_event_name,
+            field_name)} fields referenced by the form's branching logic,
+            unique_event_name is None for the current event
+
+        Concurrent calls share one computation. Calling warm_up again
+        refreshes the results, see also warm_data.
+        '''
+        return self._warming.do('warm_up', self._warm_up)
+
+    def _warm_up(self):
+        meta_data = self.load_metadata()
+        from ehb_datasources.drivers.redcap.formBuilderJson import \
+            FormBuilderJson
+        form_builder = FormBuilderJson()
+        if meta_data:
+            self._record_id_field = meta_data[0]['field_name']
+        id_field = self.record_id_field_name or self._record_id_field
+
+        form_fields = OrderedDict()
+        for field in meta_data:
+            form_fields.setdefault(field.get('form_name'), []).append(field)
+
+        form_field_info = {}
+        branching_references = {}
+        for form_name, fields in form_fields.items():
+            info = form_field_info[form_name] = {}
+            refs = branching_references[form_name] = set()
+            for field in fields:
+                refs.update(form_builder.branch_logic_references(
+                    field.get('branching_logic')))
+                name = field.get('field_name')
+                ft = (field.get('field_type') or '').lower()
+                if name == id_field:
+                    continue
+                if ft == 'checkbox':
+                    for choice in (
+                        field.get('select_choices_or_calculations') or ''
+                    ).split('|'):
+                        if choice.strip():
+                            key = form_builder.extractChoiceKeyValue(choice)[0]
+                            info['{0}___{1}'.format(name, key)] = {'type': ft}
+                elif ft in self.FORM_FIELD_TYPES:
+                    info[name] = {'type': ft}
+            info['{0}_complete'.format(form_name)] = {'type': 'dropdown'}
+
+        # a single assignment, so readers never see a partial update
+        self._warm = WarmUp(meta_data, form_fields, form_field_info,
+                            branching_references, time.monotonic())
+        return self._warm
+
+    def warm_data(self):
+        '''
+        Returns the WarmUp computed by warm_up, recomputing it first if it is
+        older than metadata_ttl (default cache_max_age) seconds, or None if
+        warm_up has not been called
+        '''
+        warm = self._warm
+        if warm is None:
+            return None
+        ttl = self.metadata_ttl
+        if ttl is None:
+            ttl = self.cache_max_age
+        if time.monotonic() - warm.loaded_at >= ttl:
+            warm = self.warm_up()
+        return warm
+
+    def get_record_id_field(self):
+        '''
+        Returns the name of the REDCap record id field, either as configured
+        or as the first field reported in the project metadata.
+        '''
+        if self.record_id_field_name:
+            return self.record_id_field_name
+        if not self._record_id_field:
+            meta_data = self.meta(_format=self.FORMAT_JSON)
+            self._record_id_field = meta_data[0]['field_name']
+        return self._record_id_field
+
+    def complete_field_names(self):
+        '''
+        Returns the form_name_complete field for each configured form
+        '''
+        return ['{0}_complete'.format(form_name)
+                for form_name in self.form_data_ordered or []]
+
+    def complete_codes_for(self, rows):
+        '''
+        Converts the *_complete values in the exported rows of a single record
+        to a dict keyed by form_spec (N for non longitudinal projects, N_M for
+        longitudinal) whose values are the REDCap completion codes
+        (0 incomplete, 1 unverified, 2 complete).
+        '''
+        codes = {}
+        for row in rows:
+            event_num = None
+            if not self.form_names:
+                try:
+                    event_num = self.unique_event_names.index(
+                        row.get('redcap_event_name'))
+                except ValueError:
+                    continue
+            for form_num, form_name in enumerate(self.form_data_ordered):
+                value = row.get('{0}_complete'.format(form_name), '')
+                if not str(value).isdigit():
+                    continue
+                if event_num is None:
+                    key = str(form_num)
+                elif self.form_data[form_name][event_num]:
+                    key = '{0}_{1}'.format(form_num, event_num)
+                else:
+                    continue
+                codes[key] = int(value)
+        return codes
+
+    def sync_snapshot(self, snapshot, now=None):
+        '''
+        Brings snapshot (see redcap.snapshot) up to date with REDCap.
+
+        The first sync exports every record, later syncs only export records
+        created or modified since the previous one (less SYNC_OVERLAP to
+        allow for clock skew) and replace those records in the snapshot.
+        Records deleted in REDCap are not reported by delta exports and remain
+        in the snapshot until they are removed with delete_records.
+
+        `now` is the end of the sync window in REDCap server time, default is
+        the local time.
+
+        Returns the number of records updated.
+        '''
+        end = now or datetime.datetime.now().replace(microsecond=0)
+        kwargs = {'dateRangeEnd': end}
+        if snapshot.last_synced:
+            kwargs['dateRangeBegin'] = snapshot.last_synced - self.SYNC_OVERLAP
+        rows = self.read_records(**kwargs) or []
+        count = snapshot.replace_records(self.get_record_id_field(), rows)
+        snapshot.last_synced = end
+        if getattr(snapshot, 'path', None):
+            snapshot.save()
+        return count
+
+    def form_complete_codes_many(self, record_ids, chunk_size=None):
+        '''
+        Returns {record_id: completion codes} (see complete_codes_for) for
+        each record in record_ids. Records are exported chunk_size at a time
+        (default COMPLETION_CHUNK_SIZE) restricted to the record id and
+        *_complete fields. Records without data map to an empty dict.
 
+        When the record cache is enabled completion codes are cached with the
+        record's other entries and dropped when the record is written.
+        '''
+        record_ids = list(OrderedDict.fromkeys(record_ids))
+        if not record_ids or not self.form_data_ordered:
+            return {}
+        chunk_size = chunk_size or self.COMPLETION_CHUNK_SIZE
+        codes = {}
+        missing = []
+        for record_id in record_ids:
+            cached = None
+            if self.record_cache is not None:
+                cached = self.record_cache.get(
+                    (record_id, self.COMPLETE_CODES_KEY))
+            if cached is not None:
+                codes[record_id] = dict(cached)
+            else:
+                missing.append(record_id)
+
+        if missing:
+            id_field = self.get_record_id_field()
+            fields = [id_field] + self.complete_field_names()
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i: i + chunk_size]
+            if self.record_cache is not None:
+                cache_version = self.record_cache.version()
+            rows = self.read_records(records=chunk, fields=fields)
+            by_record = dict((record_id, []) for record_id in chunk)
+            for row in rows or []:
+                by_record.setdefault(row.get(id_field), []).append(row)
+            for record_id in chunk:
+                codes[record_id] = self.complete_codes_for(
+                    by_record[record_id])
+                if self.record_cache is not None:
+                    self.record_cache.set(
+                        (record_id, self.COMPLETE_CODES_KEY),
+                        dict(codes[record_id]), cache_version)
+        return codes
+
+    def completion_dashboard(self, record_ids, chunk_size=None):
+        '''
+        Returns the completion status of every form for each record in
+        record_ids as
+
+            {record_id: {unique_event_name: {form_name: code}}}
+
+        where code is 0 (incomplete), 1 (unverified) or 2 (complete). Forms
+        that have never been saved are omitted. For non longitudinal projects
+        the event name is None.
+
+        See form_complete_codes_many for how the data is fetched and cached.
+        '''
+        dashboard = {}
+        codes = self.form_complete_codes_many(record_ids, chunk_size)
+        for record_id, record_codes in codes.items():
+            events = dashboard[record_id] = {}
+            for form_spec, code in record_codes.items():
+                split = form_spec.split('_')
+                form_name = self.form_data_ordered[int(split[0])]
+                event_name = None
+                if len(split) > 1:
+                    event_name = self.unique_event_names[int(split[1])]
+                events.setdefault(event_name, {})[form_name] = code
+        return dashboard
+
+    def form_complete_codes(self, record_id):
+        '''
+        Returns the completion codes (see complete_codes_for) for record_id
+        in a form suitable for subRecordSelectionForm
+        '''
+        return self.form_complete_codes_many([record_id]).get(record_id, {})
 
-    def subRecordSelectionForm(self, form_url='', redcap_form_complete_codes={}, *args, **kwargs):
+    def subRecordSelectionForm(self, form_url='', redcap_form_complete_codes=None, *args, **kwargs):
 
         '''
         Generates the REDCap data entry table.
@@ -616,6 +1393,14 @@ class ehbDriver(Driver, GenericDriver):
         ------------------------
 
         form_url = the prefix for the url for further form rendering
+
+        Optional Inputs:
+        ----------------
+
+        redcap_form_complete_codes = dict of completion codes as returned by
+            form_complete_codes
+        record_id = if redcap_form_complete_codes is not supplied, the
+            completion codes for this record are retrieved from REDCap
         '''
         # make sure the configure method has been called
         if not self.form_names and not (
@@ -626,6 +1411,11 @@ class ehbDriver(Driver, GenericDriver):
         ):
             return None
 
+        if not redcap_form_complete_codes and kwargs.get('record_id'):
+            redcap_form_complete_codes = self.form_complete_codes(
+                kwargs.get('record_id'))
+        redcap_form_complete_codes = redcap_form_complete_codes or {}
+
         def counter(start):
             while True:
                 yield start
@@ -636,19 +1426,17 @@ class ehbDriver(Driver, GenericDriver):
         def get_button_icon(key):
             all_form_status = redcap_form_complete_codes
             button_icon=[]
-            try:
-                if all_form_status[key] == 1: # form is unverified
-                    button_icon.append('btn-warning')
-                    button_icon.append('fa-adjust')
-                    return button_icon
-                elif all_form_status[key] == 2: # form is complete
-                    button_icon.append('btn-success')
-                    button_icon.append('fa-circle')
-                    return button_icon
-            except: # form is incomplete
+            status = all_form_status.get(key)
+            if status == 1: # form is unverified
+                button_icon.append('btn-warning')
+                button_icon.append('fa-adjust')
+            elif status == 2: # form is complete
+                button_icon.append('btn-success')
+                button_icon.append('fa-circle')
+            else: # form is incomplete
                 button_icon.append('btn-primary')
                 button_icon.append('fa-circle-o')
-                return button_icon
+            return button_icon
 
         if self.form_names:
             # The project is not longitudinal
@@ -733,6 +1521,9 @@ class ehbDriver(Driver, GenericDriver):
 
         If provided the driver will use the session var to cache form field
         names which improves save time performance
+
+        For longitudinal projects only the fields and events the form needs
+        are exported, see form_projection.
         '''
 
         er = external_record
@@ -755,6 +1546,7 @@ class ehbDriver(Driver, GenericDriver):
 
         split = form_spec.split('_')
         form_num = int(split[0])
+        event_num = None
 
         if not self.form_names:
             event_num = int(split[1])
@@ -771,20 +1563,16 @@ class ehbDriver(Driver, GenericDriver):
         form_name = self.form_data_ordered[form_num]
         # need to get the meta data from REDCAp to construct the form and the
         # record to populate previously entered values
+        from ehb_datasources.drivers.redcap.formBuilderJson import \
+            FormBuilderJson
         form_builder = FormBuilderJson()
-        meta_data = self.raw_to_json(self.meta(
-            _format=self.FORMAT_JSON,
-            rawResponse=True)
-        )
+        meta_data = self.form_metadata()
         session = kwargs.get('session', None)
 
+        record_set = self.form_record_set(
+            er.record_id, form_name, event_num, meta_data)
         if self.form_names:
-            record_set = self.get(_format=self.FORMAT_JSON,
-                                  records=[er.record_id],
-                                  rawResponse=True,
-                                  forms=[form_name]).read().strip()
-            record_set = self.raw_to_json(record_set)
-            return form_builder.construct_form(meta_data,
+            html = form_builder.construct_form(meta_data,
                                                record_set,
                                                form_name,
                                                er.record_id,
@@ -794,12 +1582,7 @@ class ehbDriver(Driver, GenericDriver):
                                                session,
                                                self.record_id_field_name)
         else:
-            temp = self.get(_format=self.FORMAT_JSON,
-                            rawResponse=True,
-                            records=[er.record_id])
-            record_set = temp.read().strip()
-            record_set = self.raw_to_json(record_set)
-            return form_builder.construct_form(meta_data,
+            html = form_builder.construct_form(meta_data,
                                                record_set,
                                                form_name,
                                                er.record_id,
@@ -808,6 +1591,156 @@ class ehbDriver(Driver, GenericDriver):
                                                self.event_labels,
                                                session,
                                                self.record_id_field_name)
+        return html
+
+    def form_record_set(self, record_id, form_name, event_num, meta_data,
+                        warm=None):
+        '''
+        Returns the record set subRecordForm builds form_name from: the
+        form's fields for non longitudinal projects, the form_projection
+        otherwise
+        '''
+        if self.form_names:
+            return self.record_set(record_id, forms=[form_name])
+        return self.record_set(record_id, **self.form_projection(
+            form_name, event_num, meta_data, warm))
+
+    def next_form_spec(self, form_spec):
+        '''
+        Returns the form_spec of the form following form_spec (N_M) in the
+        configured order: N+1 for non longitudinal projects, the next form
+        enabled for event M otherwise. Returns None if there is none.
+        '''
+        split = form_spec.split('_')
+        form_num = int(split[0])
+        if self.form_names:
+            if form_num + 1 < len(self.form_names):
+                return str(form_num + 1)
+            return None
+        event_num = int(split[1])
+        for num in range(form_num + 1, len(self.form_data_ordered)):
+            if self.form_data[self.form_data_ordered[num]][event_num]:
+                return '{0}_{1}'.format(num, event_num)
+        return None
+
+    def prefetch_form(self, record_id, form_spec):
+        '''
+        Loads the record data of form_spec for record_id into the record
+        cache in a background thread. Does nothing if the record cache is
+        disabled, the driver has not been warmed up (see warm_up) or the
+        same prefetch is already running. Returns the thread, or None.
+
+        The thread uses the WarmUp current when prefetch_form is called. A
+        record cache entry is only stored if the record was not invalidated
+        while it was exported (see TTLCache.set), so a prefetch racing a
+        save never caches the data from before it.
+        '''
+        if self.record_cache is None:
+            return None
+        warm = self.warm_data()
+        if warm is None:
+            return None
+        key = (record_id, form_spec)
+        with self._prefetch_lock:
+            if key in self._prefetching:
+                return None
+            self._prefetching.add(key)
+        thread = threading.Thread(
+            target=self._prefetch, args=(key, warm), daemon=True)
+        thread.start()
+        return thread
+
+    def _prefetch(self, key, warm):
+        record_id, form_spec = key
+        try:
+            split = form_spec.split('_')
+            event_num = None if self.form_names else int(split[1])
+            self.form_record_set(
+                record_id, self.form_data_ordered[int(split[0])], event_num,
+                list(warm.metadata), warm)
+        except Exception:
+            log.exception('Unable to prefetch form {0} of record {1}'.format(
+                form_spec, record_id))
+        finally:
+            with self._prefetch_lock:
+                self._prefetching.discard(key)
+
+    def form_projection(self, form_name, event_num, meta_data, warm=None):
+        '''
+        Returns the fields and events arguments restricting a longitudinal
+        record export to what rendering form_name for event event_num needs:
+        the record id field, the form's fields and _complete field, and the
+        fields (and events) referenced by the form's branching logic. Uses
+        the form_fields and branching_references of warm (a WarmUp, default
+        warm_data()) when available, otherwise meta_data.
+        '''
+        if warm is None:
+            warm = self.warm_data()
+        if warm is not None and form_name in warm.form_fields:
+            fields = warm.form_fields[form_name]
+            references = warm.branching_references.get(form_name, set())
+        else:
+            from ehb_datasources.drivers.redcap.formBuilderJson import \
+                FormBuilderJson
+            form_builder = FormBuilderJson()
+            fields = [
+                field for field in meta_data
+                if field.get('form_name') == form_name
+            ]
+            references = set()
+            for field in fields:
+                references.update(form_builder.branch_logic_references(
+                    field.get('branching_logic')))
+        id_field = (
+            self.record_id_field_name or self._record_id_field or
+            (meta_data[0]['field_name'] if meta_data else None))
+        names = [id_field] if id_field else []
+        names.extend(field.get('field_name') for field in fields)
+        names.append('{0}_complete'.format(form_name))
+        names.extend(sorted(name for event, name in references))
+        events = set(event for event, name in references)
+        events.add(self.unique_event_names[event_num])
+        return {
+            'fields': list(OrderedDict.fromkeys(names)),
+            'events': [
+                event for event in self.unique_event_names if event in events]
+        }
+
+    def form_metadata(self):
+        '''
+        Returns a fresh list of the project metadata for form construction,
+        taken from warm_up (see warm_data) or loaded by load_metadata
+        '''
+        warm = self.warm_data()
+        if warm is not None:
+            return list(warm.metadata)
+        return self.load_metadata()
+
+    def load_metadata(self):
+        '''
+        Returns the project metadata (JSON), read from the packed metadata
+        file when cache_dir is set
+        '''
+        if self.cache_dir:
+            return list(self.packed_metadata())
+        return self.raw_to_json(self.meta(
+            _format=self.FORMAT_JSON,
+            rawResponse=True)
+        )
+
+    def record_set(self, record_id, **kwargs):
+        '''
+        Returns the JSON record set for record_id (an empty list if REDCap has
+        no data for it), using the record cache when it is enabled.
+        '''
+        try:
+            return self.get(
+                record_id=record_id,
+                _format=self.FORMAT_JSON,
+                **kwargs
+            )
+        except RecordDoesNotExist:
+            return []
 
     def __getCDATA(self, item, tag_name, default=None):
             CDATA = item.getElementsByTagName(tag_name)
@@ -955,9 +1888,17 @@ class ehbDriver(Driver, GenericDriver):
         #  import request to the REDCap API
         session = kwargs.get('session', None)
         id_label = self.record_id_field_name
+        form_fields = None
         if session:
             form_fields = session.get('{0}_fields'.format(form_name), None)
-        if id_label and session and form_fields:
+        warm = None
+        if not form_fields:
+            warm = self.warm_data()
+        if warm is not None:
+            # precomputed by warm_up
+            id_label = id_label or self._record_id_field
+            form_fields = warm.form_field_info.get(form_name)
+        if id_label and form_fields:
             data_entries = ''.join(
                 [make_data_entry_from_session(field_name, field_dict) for field_name, field_dict in list(form_fields.items())]  # noqa
             )
@@ -997,12 +1938,21 @@ class ehbDriver(Driver, GenericDriver):
 
         # Now write the record to REDCap, if successful don't return anything
         try:
-            if 1 != self.write_records(
+            updated = self.write_records(
                 data=record,
                 overwrite=GenericDriver.OVERWRITE_OVERWRITE,
                 useRawData=True
-            ):
-                return ['Unknown error. REDCap reports multiple records were' +
-                        'updated, should have only been 1.']
+            )
         except Exception as error:
             return  repr(error)
+        finally:
+            self.invalidate_record(er.record_id)
+        if 1 != updated:
+            return ['Unknown error. REDCap reports multiple records were' +
+                    'updated, should have only been 1.']
+        # the save invalidated the record's cached exports, prefetch the next
+        # form now so the data it loads is not dropped
+        if self.prefetch_next_form:
+            next_spec = self.next_form_spec(form_spec)
+            if next_spec:
+                self.prefetch_form(er.record_id, next_spec)
@@ -680,6 +680,19 @@ class FormBuilderJson(object):
                             d[key] = 'undefined'
         return (d,e)
 
+    def branch_logic_references(self, branch_logic):
+        '''Returns the set of (unique_event_name, field_name) tuples referenced by a REDCap branching logic
+        expression. unique_event_name is None for references to the current event and checkbox references
+        such as [field(1)] are reported as the checkbox field itself.'''
+        refs = set()
+        if not branch_logic:
+            return refs
+        for m in re.findall(r'\[(\w+)\]\[(\w+)(?:\(\w+\))?\]', branch_logic):
+            refs.add((m[0], m[1]))
+        for m in re.findall(r'(?<!\])\[(\w+)(?:\(\w+\))?\](?!\[)', branch_logic):
+            refs.add((None, m))
+        return refs
+
     def build_branch_logic(self, meta, record_set, form_name, event_num, unique_event_names, event_labels):
         '''Outputs a 2 tuple contianing:
                a dict with entries of the form "master_field_name":["dep_field_name_1", "dep_field_name_2", ...]
@@ -0,0 +1,266 @@
+'''
+Local snapshots of REDCap project records.
+
+A snapshot holds the flat export rows of a project keyed by record id and
+event, along with the time it was last synchronised. ehbDriver.sync_snapshot
+keeps a snapshot current by exporting only the records modified since the
+previous sync (REDCap's dateRangeBegin/dateRangeEnd export parameters).
+
+RecordSnapshot keeps the rows in memory (optionally persisted to a JSON
+file), SQLiteSnapshot keeps them in an SQLite database with one table per
+project so read heavy reporting can be served locally.
+'''
+import datetime
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+EVENT_FIELD = 'redcap_event_name'
+
+
+def format_timestamp(value):
+    '''
+    Formats a datetime the way the REDCap API expects, strings are passed
+    through untouched
+    '''
+    if isinstance(value, datetime.datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return value
+
+
+def parse_timestamp(value):
+    if value:
+        return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+    return None
+
+
+class RecordSnapshot(object):
+    '''
+    In memory snapshot of a project's records, optionally persisted to a JSON
+    file at `path` (loaded on creation if it exists, written by save).
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.last_synced = None
+        self._rows = {}
+        self._lock = threading.RLock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def replace_records(self, id_field, rows):
+        '''
+        Replaces every row stored for the records present in rows, so events
+        removed from a record upstream are removed locally as well.
+        '''
+        by_record = {}
+        for row in rows:
+            by_record.setdefault(row.get(id_field), []).append(row)
+        with self._lock:
+            for record_id, record_rows in by_record.items():
+                self._rows[record_id] = record_rows
+        return len(by_record)
+
+    def delete_records(self, record_ids):
+        with self._lock:
+            for record_id in record_ids:
+                self._rows.pop(record_id, None)
+
+    def record_ids(self):
+        with self._lock:
+            return list(self._rows.keys())
+
+    def get(self, record_id=None, *args, **kwargs):
+        '''
+        Returns stored rows, accepting the same record_id, records, fields and
+        events arguments as ehbDriver.get. Returns an empty list if nothing
+        matches.
+        '''
+        records = list(kwargs.get('records') or [])
+        if record_id and record_id not in records:
+            records.append(record_id)
+        events = kwargs.get('events')
+        fields = kwargs.get('fields')
+        with self._lock:
+            if records:
+                rows = [row for r in records for row in self._rows.get(r, [])]
+            else:
+                rows = [row for rs in self._rows.values() for row in rs]
+        if events:
+            rows = [row for row in rows if row.get(EVENT_FIELD) in events]
+        if fields:
+            keep = set(fields)
+            keep.add(EVENT_FIELD)
+            rows = [
+                dict((k, v) for k, v in row.items() if k in keep)
+                for row in rows
+            ]
+        else:
+            rows = [dict(row) for row in rows]
+        return rows
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        with self._lock:
+            self.last_synced = parse_timestamp(data.get('last_synced'))
+            self._rows = data.get('records', {})
+
+    def save(self):
+        '''
+        Atomically writes the snapshot to its path
+        '''
+        with self._lock:
+            data = {
+                'last_synced': format_timestamp(self.last_synced),
+                'records': self._rows
+            }
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+
+
+class SQLiteSnapshot(object):
+    '''
+    Snapshot stored in the SQLite database at `path`. Each project has its
+    own table of (record_id, event, data) rows indexed by record id and
+    event, data being the JSON encoded export row. The database may be shared
+    by several projects and processes.
+    '''
+    # keep well below SQLite's limit on the number of host parameters
+    MAX_PARAMETERS = 500
+
+    def __init__(self, path, project):
+        self.path = path
+        self.project = project
+        self.table = 'records_{0}'.format(re.sub(r'\W', '_', str(project)))
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshot_sync '
+                '(project TEXT PRIMARY KEY, last_synced TEXT)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS "{0}" '
+                '(record_id TEXT NOT NULL, event TEXT, data TEXT NOT NULL)'
+                .format(self.table))
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS "{0}_record" ON "{0}" '
+                '(record_id, event)'.format(self.table))
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS "{0}_event" ON "{0}" (event)'
+                .format(self.table))
+
+    @property
+    def last_synced(self):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT last_synced FROM snapshot_sync WHERE project = ?',
+                (self.project,)).fetchone()
+        return parse_timestamp(row[0]) if row else None
+
+    @last_synced.setter
+    def last_synced(self, value):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO snapshot_sync VALUES (?, ?)',
+                (self.project, format_timestamp(value)))
+
+    def chunks(self, values):
+        values = list(values)
+        for i in range(0, len(values), self.MAX_PARAMETERS):
+            yield values[i: i + self.MAX_PARAMETERS]
+
+    def replace_records(self, id_field, rows):
+        '''
+        Replaces every row stored for the records present in rows
+        '''
+        by_record = {}
+        for row in rows:
+            by_record.setdefault(row.get(id_field), []).append(row)
+        with self._lock, self._connection:
+            self._delete(by_record.keys())
+            self._connection.executemany(
+                'INSERT INTO "{0}" VALUES (?, ?, ?)'.format(self.table),
+                [
+                    (record_id, row.get(EVENT_FIELD), json.dumps(row))
+                    for record_id, record_rows in by_record.items()
+                    for row in record_rows
+                ])
+        return len(by_record)
+
+    def _delete(self, record_ids):
+        for chunk in self.chunks(record_ids):
+            self._connection.execute(
+                'DELETE FROM "{0}" WHERE record_id IN ({1})'.format(
+                    self.table, ','.join('?' * len(chunk))),
+                chunk)
+
+    def delete_records(self, record_ids):
+        with self._lock, self._connection:
+            self._delete(record_ids)
+
+    def record_ids(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT DISTINCT record_id FROM "{0}"'.format(self.table))]
+
+    def query(self, records, events):
+        sql = 'SELECT data FROM "{0}"'.format(self.table)
+        where, params = [], []
+        if records:
+            where.append('record_id IN ({0})'.format(
+                ','.join('?' * len(records))))
+            params.extend(records)
+        if events:
+            where.append('event IN ({0})'.format(','.join('?' * len(events))))
+            params.extend(events)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            return [json.loads(row[0]) for row in self._connection.execute(
+                sql + ' ORDER BY rowid', params)]
+
+    def get(self, record_id=None, *args, **kwargs):
+        '''
+        Returns stored rows, accepting the same record_id, records, fields and
+        events arguments as ehbDriver.get. Returns an empty list if nothing
+        matches.
+        '''
+        records = list(kwargs.get('records') or [])
+        if record_id and record_id not in records:
+            records.append(record_id)
+        events = list(kwargs.get('events') or [])
+        fields = kwargs.get('fields')
+        if records:
+            rows = []
+            for chunk in self.chunks(records):
+                rows.extend(self.query(chunk, events))
+        else:
+            rows = self.query(None, events)
+        if fields:
+            keep = set(fields)
+            keep.add(EVENT_FIELD)
+            rows = [
+                dict((k, v) for k, v in row.items() if k in keep)
+                for row in rows
+            ]
+        return rows
+
+    def save(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,201 @@
+'''
+Registry of long lived, configured driver instances.
+
+Building a driver and calling configure on every request throws away its
+metadata and record caches, packed files and rate limit state. The registry
+keeps one configured driver per datasource and hands the same instance to
+every caller (drivers are safe to share between threads), replacing it when
+the datasource's configuration changes.
+
+    driver = drivers.get(
+        datasource.id, 'redcap', datasource.driver_configuration,
+        url=datasource.url, password=token, secure=True)
+
+Drivers may be given as classes or by name. Names are resolved lazily, the
+driver module is only imported the first time its name is used: the
+bundled drivers are listed in DRIVERS, other packages can add drivers by
+declaring an entry point in the ENTRY_POINT_GROUP group, e.g. in setup.py
+
+    entry_points={
+        'ehb_datasources.drivers': [
+            'mydriver = mypackage.driver:ehbDriver',
+        ]
+    }
+'''
+import hashlib
+import importlib
+import json
+import threading
+from collections import OrderedDict
+
+from .singleflight import SingleFlight
+
+ENTRY_POINT_GROUP = 'ehb_datasources.drivers'
+
+# name: 'module:class'
+DRIVERS = {
+    'redcap': 'ehb_datasources.drivers.redcap.driver:ehbDriver',
+    'nautilus': 'ehb_datasources.drivers.nautilus.driver:ehbDriver',
+    'phenotype': 'ehb_datasources.drivers.phenotype.driver:PhenotypeDriver',
+    'external_identifiers':
+        'ehb_datasources.drivers.external_identifiers.driver:ehbDriver',
+}
+
+_driver_classes = {}
+_driver_classes_lock = threading.Lock()
+
+
+def entry_points():
+    '''
+    Returns {name: entry point} for the drivers installed packages declare in
+    ENTRY_POINT_GROUP
+    '''
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        found = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+        return dict((entry_point.name, entry_point) for entry_point in found)
+    try:
+        found = metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # Python < 3.10
+        found = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+    return dict((entry_point.name, entry_point) for entry_point in found)
+
+
+def driver_names():
+    '''
+    Returns the names of the available drivers, without importing them
+    '''
+    return sorted(set(DRIVERS) | set(entry_points()))
+
+
+def load_driver(name):
+    '''
+    Returns the driver class registered under name, importing its module on
+    first use. Bundled drivers take precedence over entry points. Raises
+    LookupError if there is no such driver.
+    '''
+    with _driver_classes_lock:
+        driver_class = _driver_classes.get(name)
+    if driver_class is not None:
+        return driver_class
+    if name in DRIVERS:
+        module_name, class_name = DRIVERS[name].split(':')
+        driver_class = getattr(
+            importlib.import_module(module_name), class_name)
+    else:
+        entry_point = entry_points().get(name)
+        if entry_point is None:
+            raise LookupError('No datasource driver named {0}'.format(name))
+        driver_class = entry_point.load()
+    with _driver_classes_lock:
+        _driver_classes[name] = driver_class
+    return driver_class
+
+
+def config_hash(driver_class, driver_configuration='', init_kwargs=None,
+                configure_kwargs=None):
+    '''
+    Returns a digest identifying a driver class, its constructor arguments and
+    its configuration
+    '''
+    config = json.dumps(
+        [
+            '{0}.{1}'.format(driver_class.__module__, driver_class.__name__),
+            driver_configuration,
+            init_kwargs or {},
+            configure_kwargs or {}
+        ],
+        sort_keys=True,
+        default=repr
+    )
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()
+
+
+class DriverRegistry(object):
+    '''
+    Holds one configured driver per datasource id, keyed by
+    (datasource id, config hash). At most maxsize drivers are kept (least
+    recently used are evicted first) if maxsize is set.
+    '''
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._drivers = OrderedDict()
+        self._lock = threading.Lock()
+        self._building = SingleFlight()
+
+    def get(self, datasource_id, driver_class, driver_configuration='',
+            configure_kwargs=None, **init_kwargs):
+        '''
+        Returns the driver for datasource_id, creating it with
+        driver_class(**init_kwargs) (driver_class may be a name, see
+        load_driver) and calling
+        configure(driver_configuration, **configure_kwargs) if there is none
+        or if it was built from a different configuration (the old driver is
+        evicted). Concurrent calls for the same key build a single driver.
+        '''
+        if isinstance(driver_class, str):
+            driver_class = load_driver(driver_class)
+        digest = config_hash(driver_class, driver_configuration, init_kwargs,
+                             configure_kwargs)
+        with self._lock:
+            entry = self._drivers.get(datasource_id)
+            if entry and entry[0] == digest:
+                self._drivers.move_to_end(datasource_id)
+                return entry[1]
+
+        def build():
+            driver = driver_class(**init_kwargs)
+            driver.configure(driver_configuration, **(configure_kwargs or {}))
+            return driver
+
+        driver = self._building.do((datasource_id, digest), build)
+        with self._lock:
+            entry = self._drivers.get(datasource_id)
+            if entry and entry[0] == digest:
+                # built by a concurrent caller
+                return entry[1]
+            self._drivers[datasource_id] = (digest, driver)
+            self._drivers.move_to_end(datasource_id)
+            while self.maxsize and len(self._drivers) > self.maxsize:
+                self._drivers.popitem(last=False)
+        return driver
+
+    def peek(self, datasource_id):
+        '''
+        Returns the driver held for datasource_id without creating one, or
+        None
+        '''
+        with self._lock:
+            entry = self._drivers.get(datasource_id)
+        return entry[1] if entry else None
+
+    def evict(self, datasource_id):
+        '''
+        Drops the driver held for datasource_id, e.g. when the datasource's
+        configuration or credentials change. Returns the evicted driver or
+        None.
+        '''
+        with self._lock:
+            entry = self._drivers.pop(datasource_id, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._drivers.clear()
+
+    def __contains__(self, datasource_id):
+        with self._lock:
+            return datasource_id in self._drivers
+
+    def __len__(self):
+        with self._lock:
+            return len(self._drivers)
+
+
+# Shared by the whole process
+drivers = DriverRegistry()
@@ -0,0 +1,66 @@
+'''
+Request coalescing for concurrent identical calls.
+
+When several threads ask for the same thing at the same time (e.g. a number
+of AJAX panels all reading the same REDCap metadata) only the first caller
+performs the call, the others wait for it and share its result or exception.
+Nothing is cached once the call completes.
+'''
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent calls that share a key
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        '''
+        Calls fn(*args, **kwargs) unless a call for `key` is already in
+        flight, in which case this waits for and returns that call's result
+        (or raises its exception).
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+# Shared by every driver in the process
+requests = SingleFlight()
@@ -0,0 +1,72 @@
+'''
+Benchmark of Nautilus aliquot processing on large synthetic SDGs.
+
+    python -m ehb_datasources.tests.benchmarks.bench_aliquots [aliquots]
+'''
+import json
+import sys
+import time
+
+from ehb_datasources.drivers.nautilus import aliquots
+from ehb_datasources.drivers.nautilus.driver import ehbDriver
+
+STATUSES = ['V', 'V', 'C', 'P', 'U', 'X']
+TYPES = list(aliquots.SAMPLE_TYPES)
+SECONDARY_TYPES = list(aliquots.SECONDARY_SAMPLE_TYPES) + ['']
+
+
+def make_sdg(count, samples=10):
+    '''
+    Returns an SDG with count aliquots, each padded out with filler fields
+    to the ~90 fields NauREST returns
+    '''
+    sample_list = [{'ALIQUOT': []} for i in range(samples)]
+    for i in range(count):
+        sample = i % samples
+        aliquot = dict(('FIELD_{0}'.format(f), '') for f in range(85))
+        aliquot.update({
+            'NAME': 'SDG-{0}'.format(i),
+            'STATUS': STATUSES[i % len(STATUSES)],
+            'U_DISPOSED': 'T' if i % 7 == 0 else 'F',
+            'U_SAMPLE_TYPE': TYPES[i % len(TYPES)],
+            'U_SECONDARY_SAMPLE_TYPE': SECONDARY_TYPES[
+                i % len(SECONDARY_TYPES)],
+            # aliquots of a sample share their dates
+            'U_COLLECT_DATE_TIME': '{0:02d} 01 2015 14:30:19'.format(
+                sample + 1),
+            'U_RECEIVED_DATE_TIME': '{0:02d} 03 2015 14:35:07'.format(
+                sample + 1),
+        })
+        sample_list[sample]['ALIQUOT'].append(aliquot)
+    return {'SDG': {'NAME': 'SDG', 'SAMPLE': sample_list}}
+
+
+def best_time(fn, payload, repeat):
+    '''
+    Returns the best time of fn(sdg) over repeat runs, each on a freshly
+    decoded copy of payload (format_aliquots works in place)
+    '''
+    times = []
+    for i in range(repeat):
+        sdg = json.loads(payload)[0]
+        start = time.perf_counter()
+        fn(sdg)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(count=5000, repeat=5):
+    driver = ehbDriver('http://example.com/api/', 'user', 'pass', False)
+    payload = json.dumps([make_sdg(count)])
+    print('{0} aliquots'.format(count))
+    for name, fn in (
+        ('format_aliquots',
+         lambda sdg: driver.format_aliquots(driver.extract_aliquots(sdg))),
+        ('normalize_aliquots', aliquots.normalize_aliquots),
+    ):
+        print('{0:<20} {1:>8.1f}ms'.format(
+            name, best_time(fn, payload, repeat) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,95 @@
+import datetime
+import json
+
+from ehb_datasources.drivers.nautilus import aliquots
+
+
+def test_parse_datetime():
+    assert aliquots.parse_datetime('11 03 2015 14:35:07') == \
+        datetime.datetime(2015, 3, 11, 14, 35, 7)
+    # not zero padded, handled by the strptime fallback
+    assert aliquots.parse_datetime('1 3 2015 14:35:07') == \
+        datetime.datetime(2015, 3, 1, 14, 35, 7)
+    assert aliquots.parse_datetime('') is None
+    assert aliquots.parse_datetime(None) is None
+    assert aliquots.parse_datetime('31 02 2015 14:35:07') is None
+
+
+def test_raw_aliquots_shapes():
+    one = {'NAME': 'a'}
+    assert aliquots.raw_aliquots({'SDG': {'SAMPLE': {'ALIQUOT': one}}}) == [one]
+    assert aliquots.raw_aliquots(
+        {'SDG': {'SAMPLE': [{'ALIQUOT': [one, one]}, {'ALIQUOT': one}, {}]}}
+    ) == [one, one, one]
+    assert aliquots.raw_aliquots({'error': 'x'}) == []
+
+
+def test_normalize_aliquots(nautilus_get_sample_payload):
+    sdg = json.loads(nautilus_get_sample_payload.decode('utf-8'))[0]
+    normalized = aliquots.normalize_aliquots(sdg)
+    assert len(normalized) == 4
+    disposed, available, unreceived, cancelled = normalized
+    assert disposed.name == '7316-118-BLD [108880]'
+    assert disposed.status_html == aliquots.STATUS_DISPOSED
+    assert disposed.is_received and disposed.is_disposed
+    assert disposed.collected == datetime.datetime(1901, 1, 1, 14, 30, 19)
+    assert available.status_html == aliquots.STATUS_AVAILABLE
+    assert available.received is None
+    assert unreceived.status_html == aliquots.STATUS_UNRECEIVED
+    assert not unreceived.is_received
+    assert cancelled.status_html == aliquots.STATUS_CANCELLED
+    assert cancelled.label == 'Blood Flash Frozen'
+
+
+def test_filter_and_sort_aliquots(nautilus_get_sample_payload):
+    sdg = json.loads(nautilus_get_sample_payload.decode('utf-8'))[0]
+    normalized = aliquots.normalize_aliquots(sdg)
+    disposed, available, unreceived, cancelled = normalized
+    assert aliquots.filter_aliquots(normalized, statuses='cancelled') == \
+        [cancelled]
+    assert aliquots.filter_aliquots(
+        normalized, statuses=['available', 'unreceived']) == \
+        [available, unreceived]
+    assert aliquots.filter_aliquots(
+        normalized, received_after=datetime.date(2015, 3, 11)) == [disposed]
+    assert aliquots.filter_aliquots(
+        normalized, received_before=datetime.date(2015, 3, 11)) == []
+    assert aliquots.filter_aliquots(normalized, sample_types='DNA') == []
+    # aliquots without a received date come last in either direction
+    by_received = aliquots.sort_aliquots(normalized, 'received', True)
+    assert by_received[0] == disposed
+    assert aliquots.sort_aliquots(normalized, 'received', 'false') == \
+        aliquots.sort_aliquots(normalized, 'received')
+    by_status = aliquots.sort_aliquots(normalized, 'status')
+    assert [aliquots.status_category(a) for a in by_status] == \
+        ['available', 'cancelled', 'disposed', 'unreceived']
+    try:
+        aliquots.sort_aliquots(normalized, 'colour')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_paginate():
+    items = list(range(25))
+    page, info = aliquots.paginate(items, 3, 10)
+    assert page == list(range(20, 25))
+    assert info == {'page': 3, 'page_size': 10, 'pages': 3, 'total': 25,
+                    'first': 21, 'last': 25}
+    # past the end is clamped to the last page
+    assert aliquots.paginate(items, 9, 10)[1]['page'] == 3
+    page, info = aliquots.paginate(items)
+    assert page == items and info['pages'] == 1
+    page, info = aliquots.paginate([], 1, 10)
+    assert page == [] and info['first'] == info['last'] == 0
+    # request parameters arrive as strings
+    assert aliquots.paginate(items, '3', '10') == aliquots.paginate(
+        items, 3, 10)
+    assert aliquots.paginate(items, '1', '')[1]['pages'] == 1
+
+
+def test_as_bool():
+    for value in ('true', 'True', '1', 'yes', 'on', True, 1):
+        assert aliquots.as_bool(value) is True
+    for value in ('false', 'False', '0', 'no', 'off', '', None, False, 0):
+        assert aliquots.as_bool(value) is False
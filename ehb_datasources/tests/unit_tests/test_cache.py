@@ -0,0 +1,119 @@
+import time
+
+from ehb_datasources.drivers.cache import RefreshingCache, TTLCache
+
+
+class FakeTimer(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_expiry():
+    timer = FakeTimer()
+    cache = TTLCache(10, timer=timer)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    timer.now = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(10, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+
+
+def test_invalidate_where():
+    cache = TTLCache(10)
+    cache.set(('rec1', 'forms'), 1)
+    cache.set(('rec1',), 2)
+    cache.set(('rec2',), 3)
+    cache.invalidate_where(lambda key: key[0] == 'rec1')
+    assert len(cache) == 1
+    assert cache.get(('rec2',)) == 3
+
+
+def test_refreshing_cache_stale_while_revalidate():
+    import threading
+    timer = FakeTimer()
+    cache = RefreshingCache(10, stale_ttl=20, timer=timer)
+    loads = []
+    refreshed = threading.Event()
+
+    def load():
+        loads.append(timer.now)
+        if len(loads) > 1:
+            refreshed.set()
+        return len(loads)
+
+    assert cache.get('a', load) == 1
+    timer.now = 5
+    assert cache.get('a', load) == 1
+    assert loads == [0]
+    # stale: served immediately, refreshed in the background
+    timer.now = 15
+    assert cache.get('a', load) == 1
+    assert refreshed.wait(1)
+    for i in range(100):
+        if cache.get('a', load) == 2:
+            break
+        time.sleep(0.01)
+    assert cache.get('a', load) == 2
+    # expired beyond the stale window: loaded synchronously
+    timer.now = 100
+    assert cache.get('a', load) == 3
+
+
+def test_refreshing_cache_invalidate_discards_inflight_load():
+    cache = RefreshingCache(10)
+
+    def load():
+        # invalidated while loading, e.g. by an update
+        cache.invalidate('a')
+        return 'old'
+
+    assert cache.get('a', load) == 'old'
+    assert 'a' not in cache
+    assert cache.get('a', lambda: 'new') == 'new'
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_set_drops_values_loaded_before_invalidation():
+    cache = TTLCache(10, maxsize=2)
+    version = cache.version()
+    cache.invalidate('a')
+    assert not cache.set('a', 'stale', version)
+    assert 'a' not in cache
+    assert cache.set('b', 'fresh', version)
+    assert cache.set('a', 'fresh', cache.version())
+    # invalidate_where cannot match keys being loaded, every older version
+    # is stale
+    version = cache.version()
+    cache.invalidate_where(lambda key: key == 'x')
+    assert not cache.set('c', 'stale', version)
+    # forgotten invalidations make older versions stale rather than fresh
+    version = cache.version()
+    for key in 'defg':
+        cache.invalidate(key)
+    assert len(cache._invalidated) == 2
+    assert not cache.set('d', 'stale', version)
+
+
+def test_refreshing_cache_invalidations_are_bounded():
+    cache = RefreshingCache(10, maxsize=4)
+    for i in range(100):
+        cache.get(i, lambda: i)
+        cache.invalidate(i)
+    assert len(cache._cache._invalidated) == 4
+    assert len(cache) == 0
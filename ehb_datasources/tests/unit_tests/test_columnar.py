@@ -0,0 +1,119 @@
+import datetime
+import io
+
+from http.client import HTTPResponse
+
+from ehb_datasources.drivers.redcap import columnar
+from ehb_datasources.drivers.redcap.driver import ehbDriver
+
+CSV_EXPORT = (
+    'study_id,date_enrolled,age,weight,comments\n'
+    '1,2016-08-31,12,20.5,"multi\nline"\n'
+    '2,,,,\n'
+    '3,not a date,7,1,x\n'
+)
+
+
+def test_converters_from_metadata():
+    converters = columnar.converters_from_metadata([
+        {'field_name': 'a', 'text_validation_type_or_show_slider_number': 'integer'},
+        {'field_name': 'b', 'text_validation_type_or_show_slider_number': 'number_2dp'},
+        {'field_name': 'c', 'text_validation_type_or_show_slider_number': 'date_mdy'},
+        {'field_name': 'd', 'text_validation_type_or_show_slider_number': 'datetime_seconds_ymd'},
+        {'field_name': 'e', 'text_validation_type_or_show_slider_number': 'email'},
+    ])
+    assert converters == {
+        'a': columnar.to_int,
+        'b': columnar.to_float,
+        'c': columnar.to_date,
+        'd': columnar.to_datetime,
+    }
+    assert columnar.to_datetime('2016-08-31 10:15') == datetime.datetime(2016, 8, 31, 10, 15)
+    assert columnar.to_datetime('2016-08-31 10:15:07') == datetime.datetime(2016, 8, 31, 10, 15, 7)
+
+
+def test_columns_from_csv():
+    columns = columnar.columns_from_csv(CSV_EXPORT, {
+        'date_enrolled': columnar.to_date,
+        'age': columnar.to_int,
+        'weight': columnar.to_float,
+    })
+    assert list(columns.keys()) == ['study_id', 'date_enrolled', 'age', 'weight', 'comments']
+    assert columns['study_id'] == ['1', '2', '3']
+    assert columns['date_enrolled'] == [datetime.date(2016, 8, 31), None, 'not a date']
+    assert columns['age'] == [12, None, 7]
+    assert columns['weight'] == [20.5, None, 1.0]
+    assert columns['comments'] == ['multi\nline', '', 'x']
+
+
+def test_truncated_rows_are_padded():
+    rows = [
+        ['study_id', 'age', 'comments'],
+        ['1', '12'],
+        ['2', '7', 'x', 'extra'],
+        [],
+    ]
+    converters = {'age': columnar.to_int, 'comments': columnar.to_int}
+    records = list(columnar.records_from_rows(rows, converters))
+    assert records == [
+        {'study_id': '1', 'age': 12, 'comments': None},
+        {'study_id': '2', 'age': 7, 'comments': 'x'},
+    ]
+    columns = columnar.columns_from_rows(rows, converters)
+    assert columns['age'] == [12, 7]
+    assert columns['comments'] == [None, 'x']
+
+
+def test_columns_from_empty_csv():
+    assert columnar.columns_from_csv('') == {}
+
+
+def test_read_columns(mocker):
+    driver = ehbDriver(url='http://example.com/api/', password='foo')
+    metadata = mocker.MagicMock(spec=HTTPResponse, status=200)
+    metadata.read = mocker.MagicMock(
+        return_value=b'[{"field_name": "age", "text_validation_type_or_show_slider_number": "integer"}]')
+    export = mocker.MagicMock(spec=HTTPResponse, status=200)
+    body = io.BytesIO(CSV_EXPORT.encode('utf-8'))
+    export.read = mocker.MagicMock(side_effect=lambda amt=None: body.read(amt))
+    driver.POST = mocker.MagicMock(side_effect=[metadata, export])
+    columns = driver.read_columns(fields=['study_id', 'age'])
+    assert driver.POST.call_args[0][2] == 'content=record&format=csv&token=foo&type=flat&fields=study_id%2Cage'
+    assert columns['age'] == [12, None, 7]
+    assert columns['weight'] == ['20.5', '', '1']
+
+
+def test_iter_lines_across_chunks():
+    body = io.BytesIO('a,b\r\n1,"x\r\ny"\r\n2,\u00e9\r\n'.encode('utf-8'))
+
+    class Response(object):
+        def read(self, amt=None):
+            return body.read(3)
+    rows = list(columnar.iter_rows(Response()))
+    assert rows == [['a', 'b'], ['1', 'x\r\ny'], ['2', '\u00e9']]
+
+
+def test_unicode_line_separators_in_values():
+    body = io.BytesIO(
+        'id,notes,age\n1,foo\u2028bar,5\r2,a\x85b\x0cc,6\n'.encode('utf-8'))
+
+    class Response(object):
+        def read(self, amt=None):
+            return body.read(4)
+    records = list(columnar.records_from_rows(columnar.iter_rows(Response())))
+    assert records == [
+        {'id': '1', 'notes': 'foo\u2028bar', 'age': '5'},
+        {'id': '2', 'notes': 'a\x85b\x0cc', 'age': '6'}]
+
+
+def test_read_csv_records(mocker):
+    driver = ehbDriver(url='http://example.com/api/', password='foo')
+    export = mocker.MagicMock(spec=HTTPResponse, status=200)
+    body = io.BytesIO(CSV_EXPORT.encode('utf-8'))
+    export.read = mocker.MagicMock(side_effect=lambda amt=None: body.read(amt))
+    driver.POST = mocker.MagicMock(return_value=export)
+    records = driver.read_csv(typed=False, records=['1', '2', '3'])
+    assert driver.POST.call_count == 1
+    assert len(records) == 3
+    assert records[0]['comments'] == 'multi\nline'
+    assert records[1] == {'study_id': '2', 'date_enrolled': '', 'age': '', 'weight': '', 'comments': ''}
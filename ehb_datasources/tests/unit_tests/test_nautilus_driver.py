@@ -274,3 +274,200 @@ def test_process_new_record_lims(driver, mocker, expected_error_message, status_
 
     assert excinfo.typename == 'RecordCreationError'
     assert excinfo.value.cause == expected_error_message
+
+
+def test_update_many(driver, mocker):
+    MockNautilusResponse = mocker.MagicMock(status=200)
+    MockNautilusResponse.read = mocker.MagicMock(
+        return_value=b'[{"status": "200"}, {"status": "200"}]')
+    driver.PUT = mocker.MagicMock(return_value=MockNautilusResponse)
+    results = driver.update_many(
+        [{'name': 'A', 'fldvals': {'STATUS': 'V'}},
+         {'id': 2, 'fldvals': {'STATUS': 'X'}}],
+        nau_sub_path='sdg')
+    assert driver.PUT.call_count == 1
+    driver.PUT.assert_called_with(
+        '/api/sdg/',
+        {'Content-Type': 'application/json', 'NAUTILUS-CREDS': 'Basic Zm9vOmJhcg==', 'Accept': 'application/json'},
+        '[{"name": "A", "fldvals": {"STATUS": "V"}}, {"id": 2, "fldvals": {"STATUS": "X"}}]'
+    )
+    assert [r['error'] for r in results] == [None, None]
+
+
+def test_update_many_batched_with_item_errors(driver, mocker):
+    responses = [
+        mocker.MagicMock(status=200, read=mocker.MagicMock(
+            return_value=b'[{"name": "A", "status": "200"}, {"name": "B", "status": "8"}]')),
+        mocker.MagicMock(status=200, read=mocker.MagicMock(
+            return_value=b'{"error": "1"}')),
+        mocker.MagicMock(status=500),
+    ]
+    driver.PUT = mocker.MagicMock(side_effect=responses)
+    items = [{'name': n, 'fldvals': {'STATUS': 'V'}} for n in 'ABCDE']
+    results = driver.update_many(items, nau_sub_path='sdg', batch_size=2)
+    assert driver.PUT.call_count == 3
+    assert [r['status'] for r in results] == ['200', '8', '1', '1', '500']
+    assert results[0] == {'name': 'A', 'status': '200', 'error': None}
+    assert results[1]['error'] == 'Form data is not valid.'
+    assert results[2]['error'].startswith('Unable to communicate')
+    assert results[4]['error'] == 'server error.'
+
+
+def test_update_batches_size_bound(driver):
+    driver.UPDATE_BATCH_BYTES = 140
+    updates = [{'name': str(i), 'fldvals': {'X': 'y' * 30}} for i in range(5)]
+    batches = list(driver.update_batches(updates, 100))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert all(len(json.dumps(b)) <= 140 for b in batches)
+
+
+def test_default_get_many(driver, mocker):
+    from ehb_datasources.drivers.exceptions import RecordDoesNotExist
+
+    def get(record_id):
+        if record_id == 'missing':
+            raise RecordDoesNotExist(driver.url, driver.path, record_id)
+        return {'id': record_id}
+    driver.get = mocker.MagicMock(side_effect=get)
+    assert driver.get_many(['a', 'missing']) == {'a': {'id': 'a'}, 'missing': None}
+
+
+def test_get_sample_data_many(driver, mocker, nautilus_get_sample_payload):
+    def get(path, headers, body):
+        if path.endswith('BROKEN'):
+            raise ConnectionError()
+        if path.endswith('MISSING'):
+            return mocker.MagicMock(status=404)
+        return mocker.MagicMock(
+            status=200,
+            read=mocker.MagicMock(return_value=nautilus_get_sample_payload))
+    driver.GET = mocker.MagicMock(side_effect=get)
+    names = ['A', 'MISSING', 'BROKEN', 'B', 'A']
+    results = driver.get_sample_data_many(names, max_workers=3)
+    assert list(results.keys()) == ['A', 'MISSING', 'BROKEN', 'B']
+    assert driver.GET.call_count == 4
+    assert 'SDG' in results['A'] and 'SDG' in results['B']
+    assert 'does not exist' in results['MISSING']['error']
+    assert 'Unable to retrieve' in results['BROKEN']['error']
+
+
+def test_aliquot_summary_many(driver, mocker, nautilus_get_sample_payload):
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(
+        status=200,
+        read=mocker.MagicMock(return_value=nautilus_get_sample_payload)))
+    aliquots = driver.extract_aliquots(
+        json.loads(nautilus_get_sample_payload.decode('utf-8'))[0])
+    summary = driver.aliquot_summary_many(['A'])['A']
+    assert summary['total'] == len(aliquots)
+    assert sum(summary['sample_types'].values()) == len(aliquots)
+    assert summary['received'] == summary['available'] + summary['disposed']
+    assert summary['total'] == (
+        summary['received'] + summary['unreceived'] + summary['cancelled'])
+    assert driver.aliquot_summary({'error': 'x'})['error'] == 'x'
+
+
+def test_aliquot_cache_invalidated_by_update(mocker, nautilus_get_sample_payload):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        user='foo',
+        password='bar',
+        secure=False,
+        aliquot_cache_ttl=60
+    )
+    driver.GET = mocker.MagicMock(side_effect=lambda *args: mocker.MagicMock(
+        status=200,
+        read=mocker.MagicMock(return_value=nautilus_get_sample_payload)))
+    first = driver.get_aliquots('7316-118')
+    assert len(first['aliquots']) == 4
+    assert driver.get_aliquots('7316-118') is first
+    driver.subRecordSelectionForm(form_url='/test/', record_id='7316-118')
+    assert driver.GET.call_count == 1
+    driver.PUT = mocker.MagicMock(return_value=mocker.MagicMock(
+        status=200, read=mocker.MagicMock(return_value=b'[{"status": "200"}]')))
+    driver.update(name='7316-118', fldvals={'STATUS': 'V'}, nau_sub_path='sdg')
+    driver.get_aliquots('7316-118')
+    assert driver.GET.call_count == 2
+
+
+def test_aliquot_cache_skips_errors(mocker):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        user='foo',
+        password='bar',
+        secure=False,
+        aliquot_cache_ttl=60
+    )
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(status=404))
+    assert 'error' in driver.get_aliquots('missing')
+    assert 'error' in driver.get_aliquots('missing')
+    assert driver.GET.call_count == 2
+
+
+def test_aliquot_page(driver, mocker, nautilus_get_sample_payload):
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(
+        status=200,
+        read=mocker.MagicMock(return_value=nautilus_get_sample_payload)))
+    page = driver.aliquot_page('7316-118', page=2, page_size=1,
+                               sort_by='name', statuses=['disposed', 'available'])
+    assert page['count'] == 4
+    assert page['total'] == 2
+    assert page['pages'] == 2
+    assert page['rows'].count('<tr>') == 1
+    form = driver.subRecordSelectionForm(
+        form_url='/test/', record_id='7316-118', page_size=3)
+    assert form.count('<tr>') == 4
+    assert 'Showing 1-3 of 4 aliquots (page 1 of 2)' in form
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(status=404))
+    page = driver.aliquot_page('missing', page_size=10)
+    assert page['rows'] == '' and 'error' in page
+
+
+@pytest.mark.parametrize('status,body,kind,key', [
+    (200, b'[]', 'empty', 'warning'),
+    (200, b'{"error": "1"}', 'nau_error', 'error'),
+    (200, b'not json', 'unparseable', 'error'),
+    (200, b'{"status": "200"}', 'unparseable', 'error'),
+    (401, None, 'unauthorized', 'error'),
+    (404, None, 'not_found', 'error'),
+    (503, None, 'http_error', 'error'),
+])
+def test_get_sample_data_reads_once(driver, mocker, status, body, kind, key):
+    response = mocker.MagicMock(
+        status=status, read=mocker.MagicMock(return_value=body))
+    driver.GET = mocker.MagicMock(return_value=response)
+    result = driver.read_result(response)
+    assert result.kind == kind
+    response.read.reset_mock()
+    sample_data = driver.get_sample_data(record_id='TESTID')
+    assert list(sample_data.keys()) == [key]
+    assert response.read.call_count == (1 if status == 200 else 0)
+    if kind == 'nau_error':
+        assert result.error_code == '1'
+        assert sample_data['error'] == driver.NAU_ERROR_MAP['1']
+    else:
+        assert result.error_code is None
+
+
+def test_missing_sdg_cached_until_update(mocker):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        user='foo',
+        password='bar',
+        secure=False,
+        missing_sdg_ttl=60
+    )
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(status=404))
+    first = driver.get_sample_data(record_id='TYPO')
+    assert 'does not exist' in first['error']
+    assert driver.get_sample_data(record_id='TYPO') == first
+    assert driver.GET.call_count == 1
+    # other failures are not remembered
+    driver.GET = mocker.MagicMock(return_value=mocker.MagicMock(status=500))
+    driver.get_sample_data(record_id='OTHER')
+    driver.get_sample_data(record_id='OTHER')
+    assert driver.GET.call_count == 2
+    driver.PUT = mocker.MagicMock(return_value=mocker.MagicMock(
+        status=200, read=mocker.MagicMock(return_value=b'[{"status": "200"}]')))
+    driver.update(name='TYPO', fldvals={'STATUS': 'V'}, nau_sub_path='sdg')
+    driver.get_sample_data(record_id='TYPO')
+    assert driver.GET.call_count == 3
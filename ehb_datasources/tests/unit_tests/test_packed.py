@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+
+from http.client import HTTPResponse
+
+from ehb_datasources.drivers.packed import NEVER_EXPIRES, PackedRecords, \
+    write_packed
+from ehb_datasources.drivers.redcap.driver import ehbDriver
+
+
+def test_write_and_read_packed(tmpdir):
+    path = str(tmpdir.join('records.pack'))
+    items = [
+        {'study_id': 'A', 'redcap_event_name': 'visit_arm_1'},
+        {'study_id': 'A', 'redcap_event_name': 'lunch_arm_1'},
+        {'study_id': 'B', 'redcap_event_name': 'visit_arm_1', 'note': 'é'},
+    ]
+    write_packed(path, items, key='study_id')
+    with PackedRecords(path) as packed:
+        assert len(packed) == 3
+        assert packed[2] == items[2]
+        assert packed[-1] == items[2]
+        assert list(packed) == items
+        assert packed.find('A') == items[:2]
+        assert packed.find('C') == []
+
+
+def test_packed_metadata_shared_between_drivers(mocker, tmpdir, redcap_metadata_json):
+    response = mocker.MagicMock(spec=HTTPResponse, status=200)
+    response.read = mocker.MagicMock(return_value=redcap_metadata_json)
+    first = ehbDriver(url='http://example.com/api/', password='foo', cache_dir=str(tmpdir))
+    first.POST = mocker.MagicMock(return_value=response)
+    assert len(first.packed_metadata()) == 26
+    assert first.packed_metadata() is first.packed_metadata()
+
+    second = ehbDriver(url='http://example.com/api/', password='foo', cache_dir=str(tmpdir))
+    second.POST = mocker.MagicMock()
+    meta = second.form_metadata()
+    assert len(meta) == 26
+    assert meta[0]['field_name'] == 'study_id'
+    assert len(second.packed_metadata().find('demographics')) > 0
+    assert not second.POST.called
+
+
+def test_packed_metadata_rebuilt_when_old(mocker, tmpdir, redcap_metadata_json):
+    response = mocker.MagicMock(spec=HTTPResponse, status=200)
+    response.read = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver = ehbDriver(url='http://example.com/api/', password='foo', cache_dir=str(tmpdir))
+    assert driver.cache_max_age == driver.CACHE_MAX_AGE
+    driver.POST = mocker.MagicMock(return_value=response)
+    old = driver.packed_metadata()
+    path = old.path
+    stale = time.time() - driver.CACHE_MAX_AGE - 10
+    os.utime(path, (stale, stale))
+    new = driver.packed_metadata()
+    assert driver.POST.call_count == 2
+    assert new is not old
+    assert len(new) == 26
+    # the superseded mapping stays readable for whoever still holds it
+    assert len(list(old)) == 26
+
+    forever = ehbDriver(url='http://example.com/api/', password='foo',
+                        cache_dir=str(tmpdir), cache_max_age=NEVER_EXPIRES)
+    forever.POST = mocker.MagicMock()
+    os.utime(path, (0, 0))
+    assert len(forever.packed_metadata()) == 26
+    assert not forever.POST.called
+
+
+def test_packed_metadata_read_during_rebuild(mocker, tmpdir, redcap_metadata_json):
+    response = mocker.MagicMock(spec=HTTPResponse, status=200)
+    response.read = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver = ehbDriver(url='http://example.com/api/', password='foo', cache_dir=str(tmpdir))
+    driver.POST = mocker.MagicMock(return_value=response)
+    path = driver.packed_metadata().path
+    # a reader part way through the pack when another thread rebuilds it
+    reading = iter(driver.packed_metadata())
+    assert next(reading)['field_name'] == 'study_id'
+    os.utime(path, (0, 0))
+    driver.packed_metadata()
+    assert len(list(reading)) == 25
+
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                assert len(driver.load_metadata()) == 26
+        except Exception as error:
+            errors.append(error)
+    readers = [threading.Thread(target=read) for i in range(4)]
+    for reader in readers:
+        reader.start()
+    for i in range(20):
+        os.utime(path, (0, 0))
+        driver.packed_metadata()
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
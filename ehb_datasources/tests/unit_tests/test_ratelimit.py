@@ -0,0 +1,127 @@
+import pytest
+import threading
+
+from ehb_datasources.drivers import ratelimit
+from ehb_datasources.drivers.Base import RequestHandler
+from ehb_datasources.drivers.redcap.driver import ehbDriver
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    ratelimit.reset_governors()
+    yield
+    ratelimit.reset_governors()
+
+
+def test_token_bucket_burst():
+    bucket = ratelimit.TokenBucket(rate=1, capacity=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+
+
+def test_file_token_bucket_shared(tmpdir):
+    path = str(tmpdir.join('bucket'))
+    first = ratelimit.FileTokenBucket(path, rate=1, capacity=2)
+    second = ratelimit.FileTokenBucket(path, rate=1, capacity=2)
+    assert first.try_acquire() == 0
+    assert second.try_acquire() == 0
+    assert first.try_acquire() > 0
+
+
+def test_governor_shared_by_token(mocker):
+    warning = mocker.patch.object(ratelimit.log, 'warning')
+    a = ehbDriver(url='http://example.com/api/', password='foo')
+    b = ehbDriver(url='http://example.com/api/', password='foo')
+    c = ehbDriver(url='http://example.com/api/', password='bar')
+    assert a.throttle(rate=5) is b.throttle(rate=5)
+    assert not warning.called
+    assert a.governor is not c.throttle(rate=5)
+    # differing settings keep the existing governor, with a warning
+    assert b.throttle(rate=10) is a.governor
+    assert a.governor.bucket.rate == 5
+    assert warning.call_count == 1
+    assert 'foo' not in warning.call_args[0][0]
+
+
+def test_send_request_retries_429(mocker):
+    throttled = mocker.MagicMock(status=429)
+    throttled.getheader = mocker.MagicMock(return_value='0')
+    ok = mocker.MagicMock(status=200)
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(side_effect=[throttled, ok])
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    handler.throttle(max_in_flight=1)
+    response = handler.sendRequest('GET', '/api/')
+    assert response.status == 200
+    assert connection.request.call_count == 2
+    # the in flight slot is held until the body has been read
+    assert not handler.governor.semaphore.acquire(blocking=False)
+    response.read()
+    assert handler.governor.semaphore.acquire(blocking=False)
+
+
+def test_streamed_response_holds_in_flight_slot(mocker):
+    import io
+    raw = io.BytesIO(b'a,b\n1,2\n')
+    ok = mocker.MagicMock(status=200)
+    ok.read = mocker.MagicMock(side_effect=lambda amt=None: raw.read(amt))
+    ok.getheader = mocker.MagicMock(return_value=None)
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(return_value=ok)
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    handler.throttle(max_in_flight=1)
+    semaphore = handler.governor.semaphore
+    response = handler.sendRequest('GET', '/api/')
+    assert response.read(4) == b'a,b\n'
+    assert not semaphore.acquire(blocking=False)
+    assert response.read(4) == b'1,2\n'
+    assert response.read(4) == b''
+    assert semaphore.acquire(blocking=False)
+    semaphore.release()
+    # closing the connection releases the slot of an unread response
+    response = handler.sendRequest('GET', '/api/')
+    handler.closeConnection()
+    assert semaphore.acquire(blocking=False)
+
+
+def test_request_while_holding_every_slot_fails_fast(mocker):
+    ok = mocker.MagicMock(status=200)
+    ok.getheader = mocker.MagicMock(return_value=None)
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(return_value=ok)
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    handler.throttle(max_in_flight=1, acquire_timeout=0.01)
+    streamed = handler.sendRequest('GET', '/api/')
+    # the same thread would wait on itself
+    with pytest.raises(ratelimit.InFlightLimitError):
+        handler.sendRequest('GET', '/api/')
+    assert connection.request.call_count == 1
+    # other threads wait up to acquire_timeout
+    errors = []
+
+    def request():
+        try:
+            handler.sendRequest('GET', '/api/')
+        except ratelimit.InFlightLimitError as error:
+            errors.append(error)
+    thread = threading.Thread(target=request)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+    streamed.close()
+    handler.sendRequest('GET', '/api/').read()
+    assert connection.request.call_count == 2
+
+
+def test_send_request_429_without_governor(mocker):
+    throttled = mocker.MagicMock(status=429)
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(return_value=throttled)
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    assert handler.sendRequest('GET', '/api/') is throttled
+    assert connection.request.call_count == 1
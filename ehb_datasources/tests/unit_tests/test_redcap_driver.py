@@ -1,8 +1,12 @@
 import pytest
-import xml
+import json
+import threading
+import time
+import xml.dom.minidom
 
 from urllib.parse import parse_qs
 from http.client import HTTPResponse
+from ehb_datasources.drivers import singleflight
 from ehb_datasources.drivers.Base import random
 from ehb_datasources.drivers.redcap.driver import ehbDriver
 from ehb_datasources.drivers.exceptions import ServerError, RecordDoesNotExist, \
@@ -174,6 +178,16 @@ def test_create(mocker, driver, redcap_metadata_xml):
 
 
 
+def test_write_records_leaves_default_headers(mocker, driver):
+    response = mocker.MagicMock(spec=HTTPResponse, status=200)
+    response.read = mocker.MagicMock(return_value='1')
+    driver.POST = mocker.MagicMock(return_value=response)
+    assert driver.write_records('<records/>', useRawData=True) == 1
+    assert driver.POST.call_args[0][1]['Accept'] == 'text/xml'
+    assert driver.STANDARD_HEADER == {
+        'Content-Type': 'application/x-www-form-urlencoded'}
+
+
 def test_create_rce(mocker, driver, redcap_metadata_xml):
     driver.POST = mocker.MagicMock()
     # patch metadata call
@@ -401,6 +415,97 @@ def test_srf_long(mocker, driver, driver_configuration_long, redcap_metadata_jso
     assert '<td><div>Meal Description</div><div style="color:red; font-size:12px;"></div></td>' in form
 
 
+def test_srf_long_projected_fetch(mocker, driver, driver_configuration_long, redcap_metadata_json, redcap_record_json):
+    external_record = mocker.MagicMock(id=1, record_id='1')
+    driver.meta = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver.configure(driver_configuration_long)
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(return_value=redcap_record_json)
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    form = driver.subRecordForm(external_record, form_spec='1_2')
+    assert 'Meal Description' in form
+    body = parse_qs(driver.POST.call_args[0][2])
+    assert body['fields'] == [
+        'study_id,meal_description,types_of_food,healthy,'
+        'meal_description_form_complete'
+    ]
+    assert body['events'] == ['lunch_at_visit_arm_1']
+    meta_data = json.loads(redcap_metadata_json.decode('utf-8'))
+    meta_data[1]['branching_logic'] = '[visit_arm_1][meds(1)] = "1"'
+    assert driver.form_projection('demographics', 2, meta_data) == {
+        'fields': [
+            'study_id', 'date_enrolled', 'ethnicity', 'race', 'sex',
+            'given_birth', 'num_children', 'demographics_complete', 'meds'],
+        'events': ['visit_arm_1', 'lunch_at_visit_arm_1']
+    }
+
+
+def test_srf_prefetch_next_form(mocker, driver_configuration_long, redcap_metadata_json, redcap_record_json, redcap_form_datastring):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60,
+        prefetch_next_form=True
+    )
+    driver.meta = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver.configure(driver_configuration_long)
+    assert driver.next_form_spec('0_0') is None
+    assert driver.next_form_spec('0_1') == '1_1'
+    assert driver.next_form_spec('0_2') == '1_2'
+    assert driver.next_form_spec('1_3') is None
+    # the background thread never warms up the driver
+    assert driver.prefetch_form('1', '1_2') is None
+    assert driver.metadata is None
+    driver.warm_up()
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(return_value=redcap_record_json)
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    driver.write_records = mocker.MagicMock(return_value=1)
+    threads = []
+    prefetch_form = driver.prefetch_form
+    driver.prefetch_form = mocker.MagicMock(
+        side_effect=lambda *args: threads.append(prefetch_form(*args)))
+    external_record = mocker.MagicMock(id=1, record_id='1')
+    request = mocker.MagicMock(POST=parse_qs(redcap_form_datastring))
+    assert driver.processForm(request, external_record, form_spec='0_2') is None
+    # prefetched once the save has invalidated the record
+    driver.prefetch_form.assert_called_once_with('1', '1_2')
+    for thread in threads:
+        thread.join()
+    assert driver.POST.call_count == 1
+    form = driver.subRecordForm(external_record, form_spec='1_2')
+    assert 'Meal Description' in form
+    # rendered from the prefetched record data
+    assert driver.POST.call_count == 1
+
+
+def test_prefetch_racing_save_is_not_cached(mocker, driver_configuration_long, redcap_metadata_json, redcap_record_json):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60,
+        prefetch_next_form=True
+    )
+    driver.meta = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver.configure(driver_configuration_long)
+    driver.warm_up()
+
+    def export(*args, **kwargs):
+        # a save lands while the prefetch export is in flight
+        driver.invalidate_record('1')
+        response = mocker.MagicMock(spec=HTTPResponse, status=200)
+        response.read = mocker.MagicMock(return_value=redcap_record_json)
+        return response
+    driver.POST = mocker.MagicMock(side_effect=export)
+    driver.prefetch_form('1', '1_2').join()
+    assert driver.POST.call_count == 1
+    assert len(driver.record_cache) == 0
+
+
 def test_srf_nonlong(mocker, driver, driver_configuration_nonlong, redcap_metadata_json, redcap_record_json):
     # Mocks
     # External Record
@@ -810,3 +915,345 @@ def test_srsf_redcap_completion_codes(mocker, driver, driver_configuration_long,
     assert 'fa-circle' in form
     assert 'btn-warning' in form
     assert 'fa-adjust' in form
+
+
+def test_concurrent_metadata_reads_coalesced(mocker, driver, redcap_metadata_json):
+    started = threading.Event()
+    release = threading.Event()
+    waiting = threading.Semaphore(0)
+
+    class Done(threading.Event):
+        def wait(self, timeout=None):
+            # a follower joined the in flight call
+            waiting.release()
+            return super(Done, self).wait(timeout)
+
+    class Call(singleflight._Call):
+        def __init__(self):
+            super(Call, self).__init__()
+            self.done = Done()
+    mocker.patch.object(singleflight, '_Call', Call)
+
+    def slow_read():
+        started.set()
+        release.wait(5)
+        return redcap_metadata_json
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(side_effect=slow_read)
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(driver.meta()))
+               for i in range(4)]
+    threads[0].start()
+    assert started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    for t in threads[1:]:
+        assert waiting.acquire(timeout=5)
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(results) == 4
+    assert all(len(meta) == 26 for meta in results)
+    # each caller gets its own parsed copy
+    assert results[0] is not results[1]
+    assert driver.POST.call_count == 1
+
+
+def test_get_record_cache(mocker, driver_configuration_long, redcap_record_json, redcap_metadata_xml, redcap_form_datastring):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60
+    )
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(return_value=redcap_record_json)
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    first = driver.get(record_id='0GUQDBCDE0EAWN9Q:8LAG76CHO')
+    first[0]['study_id'] = 'changed'
+    second = driver.get(record_id='0GUQDBCDE0EAWN9Q:8LAG76CHO')
+    assert driver.POST.call_count == 1
+    assert second[0]['study_id'] == '0GUQDBCDE0EAWN9Q:8LAG76CHO'
+    # Different projections are cached separately
+    driver.get(record_id='0GUQDBCDE0EAWN9Q:8LAG76CHO', forms=['demographics'])
+    assert driver.POST.call_count == 2
+    # Writing the record invalidates it
+    external_record = mocker.MagicMock(record_id='0GUQDBCDE0EAWN9Q:8LAG76CHO')
+    driver.meta = mocker.MagicMock(
+        return_value=driver.transformResponse('xml', redcap_metadata_xml))
+    driver.configure(driver_configuration_long)
+    driver.write_records = mocker.MagicMock(return_value=1)
+    request = mocker.MagicMock(POST=parse_qs(redcap_form_datastring))
+    assert driver.processForm(request, external_record, form_spec='0_0') is None
+    driver.get(record_id='0GUQDBCDE0EAWN9Q:8LAG76CHO')
+    assert driver.POST.call_count == 3
+
+
+def test_record_cache_key_freezes_arguments(mocker):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60,
+        missing_record_ttl=60
+    )
+    driver.read_records = mocker.MagicMock(return_value=[{'study_id': '1'}])
+    assert driver.get(record_id='1', fields={'study_id', 'age'}) == [
+        {'study_id': '1'}]
+    driver.get(record_id='1', fields=frozenset(['age', 'study_id']))
+    driver.get(record_id='1', fields=['age', 'study_id'])
+    assert driver.read_records.call_count == 1
+    driver.get(record_id='1', fields={'study_id': {'age'}})
+    assert driver.read_records.call_count == 2
+
+    class Unhashable(object):
+        __hash__ = None
+    # exports whose arguments cannot be hashed bypass the caches
+    for i in range(2):
+        driver.get(record_id='1', fields=[Unhashable()])
+    assert driver.read_records.call_count == 4
+
+
+def test_form_complete_codes_many(mocker, driver, driver_configuration_long):
+    driver.configure(driver_configuration_long)
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(return_value=b'''[
+        {"study_id": "A", "redcap_event_name": "visit_arm_1", "baseline_visit_data_complete": "2", "meal_description_form_complete": ""},
+        {"study_id": "A", "redcap_event_name": "lunch_at_visit_arm_1", "baseline_visit_data_complete": "", "meal_description_form_complete": "1"},
+        {"study_id": "B", "redcap_event_name": "dinner_at_visit_arm_1", "baseline_visit_data_complete": "", "meal_description_form_complete": "0"}
+    ]''')
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    codes = driver.form_complete_codes_many(['A', 'B', 'C'])
+    assert driver.POST.call_count == 1
+    assert driver.POST.call_args[0][2] == (
+        'content=record&format=json&token=foo&type=flat&records=A%2CB%2CC&fields=study_id%2Cbaseline_visit_data_complete%2Cmeal_description_form_complete')
+    assert codes == {
+        'A': {'0_0': 2, '1_2': 1},
+        'B': {'1_3': 0},
+        'C': {}
+    }
+
+
+def test_srsf_fetches_completion_codes(mocker, driver, driver_configuration_nonlong):
+    driver.configure(driver_configuration_nonlong)
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(
+        return_value=b'[{"study_id": "A", "demographics_complete": "2", "baseline_data_complete": "0"}]')
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    form = driver.subRecordSelectionForm(form_url='/test/', record_id='A')
+    assert driver.POST.call_count == 1
+    assert 'btn-success' in form
+    assert 'btn-primary' in form
+
+
+def test_completion_dashboard_chunked_and_cached(mocker, driver_configuration_long):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60
+    )
+    driver.configure(driver_configuration_long)
+    first = mocker.MagicMock(spec=HTTPResponse, status=200)
+    first.read = mocker.MagicMock(return_value=b'''[
+        {"study_id": "A", "redcap_event_name": "visit_arm_1", "baseline_visit_data_complete": "2", "meal_description_form_complete": ""},
+        {"study_id": "B", "redcap_event_name": "lunch_at_visit_arm_1", "baseline_visit_data_complete": "", "meal_description_form_complete": "1"}
+    ]''')
+    second = mocker.MagicMock(spec=HTTPResponse, status=200)
+    second.read = mocker.MagicMock(return_value=b'[]')
+    driver.POST = mocker.MagicMock(side_effect=[first, second])
+    dashboard = driver.completion_dashboard(['A', 'B', 'C'], chunk_size=2)
+    assert driver.POST.call_count == 2
+    assert dashboard == {
+        'A': {'visit_arm_1': {'baseline_visit_data': 2}},
+        'B': {'lunch_at_visit_arm_1': {'meal_description_form': 1}},
+        'C': {}
+    }
+    # served from the cache
+    assert driver.completion_dashboard(['A', 'B', 'C'], chunk_size=2) == dashboard
+    assert driver.POST.call_count == 2
+    driver.invalidate_record('A')
+    third = mocker.MagicMock(spec=HTTPResponse, status=200)
+    third.read = mocker.MagicMock(return_value=b'[]')
+    driver.POST = mocker.MagicMock(return_value=third)
+    assert driver.completion_dashboard(['A', 'B'])['A'] == {}
+    assert driver.POST.call_args[0][2].count('records=A&') == 1
+
+
+def test_configure_warm_up(mocker, driver, driver_configuration_long, redcap_metadata_json, redcap_form_datastring):
+    MockREDCapResponse = mocker.MagicMock(
+        spec=HTTPResponse,
+        status=200)
+    MockREDCapResponse.read = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver.POST = mocker.MagicMock(return_value=MockREDCapResponse)
+    driver.configure(driver_configuration_long, warm_up=True)
+    assert driver.POST.call_count == 1
+    assert list(driver.form_fields.keys()) == ['demographics', 'baseline_visit_data', 'meal_description_form']
+    assert driver.branching_references['demographics'] == {(None, 'sex'), (None, 'given_birth')}
+    info = driver.form_field_info['baseline_visit_data']
+    assert info['meds___1'] == {'type': 'checkbox'}
+    assert info['baseline_visit_data_complete'] == {'type': 'dropdown'}
+    assert 'specify_mood' not in info
+    assert 'study_id' not in driver.form_field_info['demographics']
+
+    # processForm no longer needs the XML metadata
+    driver.meta = mocker.MagicMock()
+    driver.write_records = mocker.MagicMock(return_value=1)
+    request = mocker.MagicMock(POST=parse_qs(redcap_form_datastring))
+    external_record = mocker.MagicMock(record_id='A')
+    assert driver.processForm(request, external_record, form_spec='0_0') is None
+    assert not driver.meta.called
+    payload = driver.write_records.call_args[1]['data']
+    assert '<meds___2><![CDATA[0]]></meds___2>' in payload
+    assert '<study_id><![CDATA[A]]></study_id>' in payload
+
+
+def test_warm_up_expires(mocker, driver_configuration_long, redcap_metadata_json):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        metadata_ttl=60
+    )
+    first = mocker.MagicMock(spec=HTTPResponse, status=200)
+    first.read = mocker.MagicMock(return_value=redcap_metadata_json)
+    driver.POST = mocker.MagicMock(return_value=first)
+    driver.configure(driver_configuration_long, warm_up=True)
+    assert driver.warm_data() is driver.warm_data()
+    assert driver.POST.call_count == 1
+
+    # a field was added upstream
+    meta_data = json.loads(redcap_metadata_json.decode('utf-8'))
+    meta_data.append(dict(meta_data[-1], field_name='dessert'))
+    second = mocker.MagicMock(spec=HTTPResponse, status=200)
+    second.read = mocker.MagicMock(
+        return_value=json.dumps(meta_data).encode('utf-8'))
+    driver.POST = mocker.MagicMock(return_value=second)
+    driver._warm = driver._warm._replace(loaded_at=time.monotonic() - 61)
+    assert len(driver.form_metadata()) == 27
+    assert driver.POST.call_count == 1
+    assert 'dessert' in driver.form_field_info['meal_description_form']
+
+
+def test_get_many_chunked(mocker, driver, driver_configuration_nonlong):
+    driver.configure(driver_configuration_nonlong)
+    driver.read_records = mocker.MagicMock(side_effect=[
+        [{'study_id': 'A', 'age': '1'}, {'study_id': 'B', 'age': '2'}],
+        []
+    ])
+    records = driver.get_many(['A', 'B', 'C'], fields=['age'], chunk_size=2)
+    assert list(records.keys()) == ['A', 'B', 'C']
+    assert records['B'] == [{'study_id': 'B', 'age': '2'}]
+    assert records['C'] is None
+    driver.read_records.assert_called_with(
+        records=['C'], fields=['study_id', 'age'])
+    # records given as a keyword are merged into record_ids
+    driver.read_records = mocker.MagicMock(return_value=[])
+    records = driver.get_many(['A'], records=['B', 'A'])
+    assert list(records.keys()) == ['A', 'B']
+    driver.read_records.assert_called_once_with(records=['A', 'B'])
+
+
+def test_create_many_single_import(mocker, driver, driver_configuration_long):
+    driver.configure(driver_configuration_long)
+    driver.create_random_record_id = mocker.MagicMock(
+        side_effect=['TAKEN', 'FREE'])
+    driver.read_records = mocker.MagicMock(
+        return_value=[{'study_id': 'P:TAKEN'}])
+    driver.write_records = mocker.MagicMock(return_value=3)
+    created = driver.create_many(
+        'P', None,
+        [{'record_id': 'A'}, {}, {'record_id': 'B',
+                                  'record_values': [('age', '3')]}])
+    assert created == ['P:A', 'P:FREE', 'P:B']
+    assert driver.write_records.call_count == 1
+    written = driver.write_records.call_args[1]['data'].toxml()
+    assert written.count('<item>') == 3
+    assert '<age><![CDATA[3]]></age>' in written
+
+
+def test_create_many_partial_write(mocker, driver, driver_configuration_nonlong):
+    driver.configure(driver_configuration_nonlong)
+    driver.write_records = mocker.MagicMock(return_value=1)
+    with pytest.raises(RecordCreationError):
+        driver.create_many(None, None, [{'record_id': 'A'}, {'record_id': 'B'}])
+
+
+def test_update_many(mocker, driver, driver_configuration_nonlong):
+    driver.configure(driver_configuration_nonlong)
+    driver.write_records = mocker.MagicMock(side_effect=[2, 1])
+    results = driver.update_many(
+        [{'study_id': 'A', 'age': '1'}, {'study_id': 'B', 'age': ']]>'},
+         {'study_id': 'C', 'age': '3'}],
+        chunk_size=2)
+    assert results == [
+        {'record_id': 'A', 'error': None},
+        {'record_id': 'B', 'error': None},
+        {'record_id': 'C', 'error': None}]
+    assert driver.write_records.call_count == 2
+    data = driver.write_records.call_args_list[0][1]['data']
+    ages = [
+        node.firstChild.wholeText
+        for node in data.getElementsByTagName('age')]
+    assert ages == ['1', ']]>']
+
+
+def test_update_many_failed_chunk(mocker, driver, driver_configuration_nonlong):
+    driver.configure(driver_configuration_nonlong)
+    driver.write_records = mocker.MagicMock(
+        side_effect=[Exception('rejected'), 1])
+    results = driver.update_many(
+        [{'study_id': 'A', 'age': 'x'}, {'study_id': 'B', 'age': '2'},
+         {'study_id': 'C', 'age': '3'}],
+        chunk_size=2)
+    assert [result['record_id'] for result in results] == ['A', 'B', 'C']
+    assert results[0]['error'] == results[1]['error'] == repr(
+        Exception('rejected'))
+    assert results[2]['error'] is None
+
+
+def test_missing_record_cached_until_create(mocker, driver_configuration_long):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        missing_record_ttl=60
+    )
+    driver.configure(driver_configuration_long)
+    empty = mocker.MagicMock(spec=HTTPResponse, status=200)
+    empty.read = mocker.MagicMock(return_value=b'[]')
+    driver.POST = mocker.MagicMock(return_value=empty)
+    for i in range(2):
+        with pytest.raises(RecordDoesNotExist):
+            driver.get(record_id='A')
+    assert driver.POST.call_count == 1
+    # a different export of the record is not answered by the miss
+    with pytest.raises(RecordDoesNotExist):
+        driver.get(record_id='A', fields=['study_id'])
+    assert driver.POST.call_count == 2
+    driver.invalidate_record('A')
+    with pytest.raises(RecordDoesNotExist):
+        driver.get(record_id='A')
+    assert driver.POST.call_count == 3
+
+
+def test_record_cache_skips_export_racing_a_write(mocker, driver_configuration_long):
+    driver = ehbDriver(
+        url='http://example.com/api/',
+        password='foo',
+        record_cache_ttl=60
+    )
+    driver.configure(driver_configuration_long)
+
+    def read_records(**kwargs):
+        # the record is written while it is being exported
+        driver.invalidate_record('A')
+        return [{'study_id': 'A'}]
+    driver.read_records = mocker.MagicMock(side_effect=read_records)
+    driver.get(record_id='A')
+    driver.get(record_id='A')
+    assert driver.read_records.call_count == 2
@@ -0,0 +1,117 @@
+import pytest
+import threading
+import time
+
+from ehb_datasources.drivers.redcap.driver import ehbDriver
+from ehb_datasources.drivers.registry import DriverRegistry
+
+
+class SlowDriver(object):
+    built = 0
+
+    def __init__(self, url):
+        self.url = url
+        SlowDriver.built += 1
+
+    def configure(self, driver_configuration='', **kwargs):
+        time.sleep(0.05)
+        self.config = driver_configuration
+
+
+def test_driver_reused(driver_configuration_long):
+    registry = DriverRegistry()
+    driver = registry.get(
+        1, ehbDriver, driver_configuration_long,
+        url='http://example.com/api/', password='foo')
+    assert driver.form_data_ordered
+    assert registry.get(
+        1, ehbDriver, driver_configuration_long,
+        url='http://example.com/api/', password='foo') is driver
+    assert registry.peek(1) is driver
+
+
+def test_configuration_change_evicts(driver_configuration_long,
+                                     driver_configuration_nonlong):
+    registry = DriverRegistry()
+    kwargs = {'url': 'http://example.com/api/', 'password': 'foo'}
+    first = registry.get(1, ehbDriver, driver_configuration_long, **kwargs)
+    second = registry.get(1, ehbDriver, driver_configuration_nonlong, **kwargs)
+    assert second is not first
+    assert second.form_names
+    kwargs['password'] = 'bar'
+    assert registry.get(
+        1, ehbDriver, driver_configuration_nonlong, **kwargs) is not second
+    assert len(registry) == 1
+    assert registry.evict(1) is not None
+    assert 1 not in registry
+
+
+def test_concurrent_get_builds_once():
+    registry = DriverRegistry()
+    SlowDriver.built = 0
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                registry.get('ds', SlowDriver, 'cfg', url='x')))
+        for i in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert SlowDriver.built == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_lru_eviction():
+    registry = DriverRegistry(maxsize=2)
+    a = registry.get('a', SlowDriver, url='a')
+    registry.get('b', SlowDriver, url='b')
+    assert registry.get('a', SlowDriver, url='a') is a
+    registry.get('c', SlowDriver, url='c')
+    assert 'a' in registry
+    assert 'b' not in registry
+
+
+def test_drivers_resolved_by_name(mocker, driver_configuration_long):
+    from ehb_datasources.drivers import registry as registry_module
+    from ehb_datasources.drivers.nautilus.driver import ehbDriver as Nautilus
+    assert registry_module.load_driver('nautilus') is Nautilus
+    assert 'redcap' in registry_module.driver_names()
+    registry = DriverRegistry()
+    driver = registry.get(
+        1, 'redcap', driver_configuration_long,
+        url='http://example.com/api/', password='foo')
+    assert isinstance(driver, ehbDriver)
+
+
+def test_entry_point_drivers(mocker):
+    from ehb_datasources.drivers import registry as registry_module
+    entry_point = mocker.MagicMock()
+    entry_point.name = 'slow'
+    entry_point.load = mocker.MagicMock(return_value=SlowDriver)
+    mocker.patch.object(registry_module, 'entry_points',
+                        return_value={'slow': entry_point})
+    mocker.patch.dict(registry_module._driver_classes, clear=True)
+    assert 'slow' in registry_module.driver_names()
+    assert registry_module.load_driver('slow') is SlowDriver
+    with pytest.raises(LookupError):
+        registry_module.load_driver('missing')
+
+
+def test_entry_points_without_importlib_metadata(mocker, monkeypatch):
+    import importlib
+    from ehb_datasources.drivers import registry as registry_module
+    entry_point = mocker.MagicMock()
+    entry_point.name = 'slow'
+    pkg_resources = mocker.MagicMock()
+    pkg_resources.iter_entry_points = mocker.MagicMock(
+        return_value=iter([entry_point]))
+    # importing importlib.metadata fails as on Python < 3.8
+    monkeypatch.delattr(importlib, 'metadata', raising=False)
+    mocker.patch.dict('sys.modules', {
+        'importlib.metadata': None, 'pkg_resources': pkg_resources})
+    assert registry_module.entry_points() == {'slow': entry_point}
+    pkg_resources.iter_entry_points.assert_called_once_with(
+        registry_module.ENTRY_POINT_GROUP)
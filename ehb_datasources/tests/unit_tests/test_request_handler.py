@@ -0,0 +1,104 @@
+import gzip
+import io
+import zlib
+
+from ehb_datasources.drivers.Base import RequestHandler, DecodedResponse
+
+
+def mock_response(mocker, body, encoding=None, status=200):
+    raw = io.BytesIO(body)
+    response = mocker.MagicMock(status=status)
+    response.read = mocker.MagicMock(side_effect=lambda amt=None: raw.read(amt))
+    response.getheader = mocker.MagicMock(
+        side_effect=lambda name, default=None: encoding if name == 'Content-Encoding' else default)
+    return response
+
+
+def test_gzip_response_decoded(mocker):
+    payload = b'[{"study_id": "1"}]' * 1000
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(
+        return_value=mock_response(mocker, gzip.compress(payload), 'gzip'))
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    response = handler.sendRequest('POST', '/api/', {'Content-Type': 'text/plain'}, 'foo')
+    assert handler.processResponse(response) == payload
+    headers = connection.request.call_args[0][3]
+    assert headers['Accept-Encoding'] == 'gzip, deflate'
+    assert headers['Content-Type'] == 'text/plain'
+
+
+def test_deflate_streaming(mocker):
+    payload = b'0123456789' * 20000
+    raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = raw_deflate.compress(payload) + raw_deflate.flush()
+    response = DecodedResponse(mock_response(mocker, body, 'deflate'), 'deflate')
+    chunks = []
+    chunk = response.read(4096)
+    while chunk:
+        chunks.append(chunk)
+        chunk = response.read(4096)
+    assert b''.join(chunks) == payload
+    assert max(len(c) for c in chunks) == 4096
+
+
+def test_decoded_line_reads(mocker):
+    payload = b''.join(
+        '{0},value {0}\n'.format(i).encode('utf-8') for i in range(5000))
+    response = DecodedResponse(
+        mock_response(mocker, gzip.compress(payload), 'gzip'), 'gzip')
+    assert response.peek().startswith(b'0,value 0\n')
+    assert response.readline() == b'0,value 0\n'
+    assert response.readline(3) == b'1,v'
+    assert response.readline() == b'alue 1\n'
+    buffer = bytearray(8)
+    assert response.readinto(buffer) == 8
+    assert bytes(buffer) == b'2,value '
+    assert response.readlines(4) == [b'2\n', b'3,value 3\n']
+    lines = list(response)
+    assert len(lines) == 4996
+    assert lines[-1] == b'4999,value 4999\n'
+    assert response.readline() == b''
+    assert response.readinto(buffer) == 0
+
+
+def test_identity_response_untouched(mocker):
+    response = mock_response(mocker, b'[]')
+    assert RequestHandler('example.com').decodeResponse(response) is response
+
+
+def test_compress_large_request_bodies(mocker):
+    handler = RequestHandler('example.com')
+    handler.compress_requests = True
+    handler.compress_min_size = 10
+    headers, body = handler.encodeRequest({}, 'data=' + 'x' * 100)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == b'data=' + b'x' * 100
+    headers, body = handler.encodeRequest({}, 'data=x')
+    assert 'Content-Encoding' not in headers
+    assert body == 'data=x'
+
+
+def test_request_state_is_per_thread(mocker):
+    import threading
+    connection = mocker.MagicMock()
+    connection.getresponse = mocker.MagicMock(
+        side_effect=lambda: mock_response(mocker, b'[]'))
+    mocker.patch('http.client.HTTPConnection', return_value=connection)
+    handler = RequestHandler('example.com')
+    handler.POST('/api/', {}, 'main')
+    seen = []
+
+    def worker():
+        seen.append(handler.lastrequestbody)
+        handler.POST('/api/', {}, 'worker')
+        seen.append(handler.lastrequestbody)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert seen == ['', 'worker']
+    assert handler.lastrequestbody == 'main'
+    assert handler.currentConnection is connection
+    handler.closeConnection()
+    assert handler.currentConnection is None
@@ -0,0 +1,93 @@
+import datetime
+import pytest
+
+from http.client import HTTPResponse
+from urllib.parse import parse_qs
+
+from ehb_datasources.drivers.redcap.driver import ehbDriver
+from ehb_datasources.drivers.exceptions import RecordDoesNotExist
+from ehb_datasources.drivers.redcap.snapshot import RecordSnapshot, SQLiteSnapshot
+
+
+def mock_export(mocker, body):
+    response = mocker.MagicMock(spec=HTTPResponse, status=200)
+    response.read = mocker.MagicMock(return_value=body)
+    return response
+
+
+def test_sync_snapshot_delta(mocker, tmpdir, driver_configuration_long):
+    driver = ehbDriver(url='http://example.com/api/', password='foo')
+    driver.configure(driver_configuration_long)
+    path = str(tmpdir.join('project.json'))
+    snapshot = RecordSnapshot(path)
+    driver.POST = mocker.MagicMock(side_effect=[
+        mock_export(mocker, b'''[
+            {"study_id": "A", "redcap_event_name": "visit_arm_1", "weight": "20"},
+            {"study_id": "A", "redcap_event_name": "lunch_at_visit_arm_1", "weight": ""},
+            {"study_id": "B", "redcap_event_name": "visit_arm_1", "weight": "30"}
+        ]'''),
+        mock_export(mocker, b'''[
+            {"study_id": "A", "redcap_event_name": "visit_arm_1", "weight": "21"}
+        ]''')
+    ])
+    first = datetime.datetime(2016, 8, 31, 10, 0, 0)
+    assert driver.sync_snapshot(snapshot, now=first) == 2
+    params = parse_qs(driver.POST.call_args[0][2])
+    assert params['dateRangeEnd'] == ['2016-08-31 10:00:00']
+    assert 'dateRangeBegin' not in params
+
+    second = datetime.datetime(2016, 8, 31, 11, 0, 0)
+    assert driver.sync_snapshot(snapshot, now=second) == 1
+    params = parse_qs(driver.POST.call_args[0][2])
+    assert params['dateRangeBegin'] == ['2016-08-31 09:55:00']
+    assert params['dateRangeEnd'] == ['2016-08-31 11:00:00']
+
+    # persisted and reloadable
+    snapshot = RecordSnapshot(path)
+    assert snapshot.last_synced == second
+    assert snapshot.get(record_id='A') == [
+        {'study_id': 'A', 'redcap_event_name': 'visit_arm_1', 'weight': '21'}]
+    assert snapshot.get(records=['B'], fields=['weight']) == [
+        {'redcap_event_name': 'visit_arm_1', 'weight': '30'}]
+    assert len(snapshot.get(events=['visit_arm_1'])) == 2
+
+
+def test_sqlite_snapshot(mocker, tmpdir, driver_configuration_long):
+    path = str(tmpdir.join('snapshots.db'))
+    driver = ehbDriver(url='http://example.com/api/', password='foo')
+    driver.configure(driver_configuration_long)
+    driver.snapshot = SQLiteSnapshot(path, 'project-1')
+    driver.POST = mocker.MagicMock(return_value=mock_export(mocker, b'''[
+        {"study_id": "A", "redcap_event_name": "visit_arm_1", "weight": "20"},
+        {"study_id": "A", "redcap_event_name": "lunch_at_visit_arm_1", "weight": ""},
+        {"study_id": "B", "redcap_event_name": "visit_arm_1", "weight": "30"}
+    ]'''))
+    now = datetime.datetime(2016, 8, 31, 10, 0, 0)
+    assert driver.sync_snapshot(driver.snapshot, now=now) == 2
+    assert driver.POST.call_count == 1
+
+    rows = driver.get(record_id='A', local=True)
+    assert [row['redcap_event_name'] for row in rows] == ['visit_arm_1', 'lunch_at_visit_arm_1']
+    assert driver.get(records=['A', 'B'], events=['visit_arm_1'], fields=['weight'], local=True) == [
+        {'redcap_event_name': 'visit_arm_1', 'weight': '20'},
+        {'redcap_event_name': 'visit_arm_1', 'weight': '30'}]
+    with pytest.raises(RecordDoesNotExist):
+        driver.get(record_id='C', local=True)
+    assert driver.POST.call_count == 1
+
+    # Other projects in the same database are independent
+    other = SQLiteSnapshot(path, 'project-2')
+    assert other.last_synced is None
+    assert other.get() == []
+    assert SQLiteSnapshot(path, 'project-1').last_synced == now
+    driver.snapshot.delete_records(['A'])
+    assert driver.snapshot.record_ids() == ['B']
+
+
+def test_local_get_without_snapshot(mocker):
+    driver = ehbDriver(url='http://example.com/api/', password='foo')
+    driver.POST = mocker.MagicMock()
+    with pytest.raises(Exception) as error:
+        driver.get(record_id='A', local=True)
+    assert 'requires a snapshot' in str(error.value)
+    assert not driver.POST.called